@@ -0,0 +1,322 @@
+# benchmark.py
+#
+# End-to-end benchmark for the check pipeline, runnable offline:
+#
+#   python benchmark.py                      # run and compare with benchmark_baseline.json
+#   python benchmark.py --chats 100000       # bigger alert population
+#   python benchmark.py --update-baseline    # store this machine's numbers as the new baseline
+#
+# It generates calendar pages in the site's markup, serves them (and the cookie page) from
+# a local HTTP server, builds a synthetic alert population and sends through a recording
+# fake bot.
+#
+# Absolute timings depend on the machine, so every stage is compared as a multiple of a
+# reference stage that runs none of our code (BeautifulSoup reading the same pages), timed
+# in the same run. The process exits with status 1 if a stage takes a larger multiple of
+# the reference than in the baseline, by more than the tolerance.
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from bs4 import BeautifulSoup
+
+# The benchmark must never touch the real database or page archive, so point DB_NAME and
+# PAGE_ARCHIVE_DIR at scratch locations before any module that reads the config is imported.
+# Archiving stays on, as in production, so its cost is part of the fetch stages.
+_SCRATCH_DIR = tempfile.mkdtemp(prefix="fencing-bench-")
+os.environ["DB_NAME"] = os.path.join(_SCRATCH_DIR, "bench.db")
+os.environ["PAGE_ARCHIVE_DIR"] = os.path.join(_SCRATCH_DIR, "page_archive")
+
+import database as db  # noqa: E402
+import parsers  # noqa: E402
+import scraper  # noqa: E402
+from calendars import get_calendar  # noqa: E402
+from dispatcher import Notification, NotificationDispatcher  # noqa: E402
+from fake_bot import FakeBot  # noqa: E402
+from matcher import DAY_NAMES, slot_day_mask  # noqa: E402
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+COACH_NAMES = ["Arseni", "David G", "Igor", "Maria K", "Sergei", "Anna B", "Viktor", "Elena", "Tomas", "Olga"]
+
+
+# --- Synthetic Data ---
+
+def generate_calendar_html(week_start: date, coaches: int, slots_per_day: int,
+                           availability: float = 0.2, seed: int = 0) -> bytes:
+    """
+    One week of calendar in the same structure the live site uses: a td.tdborder column
+    per day with a height=34 day header, and per coach a #ffff66 header row followed
+    by two-cell slot rows (an <input> marks a bookable slot).
+    """
+    rng = random.Random(seed)
+    html = ['<html><body><table class="maintable"><tr>']
+    for offset in range(7):
+        day = week_start + timedelta(days=offset)
+        html.append('<td class="tdborder" valign="top"><table width="100%" cellspacing="0">')
+        html.append(f'<tr height="34"><td colspan="2" align="center">'
+                    f'<a class="mainbold">{DAY_NAMES[day.weekday()]}</a><br>'
+                    f'<a class="smallbold">{day.month}/{day.day}/{day.year}</a></td></tr>')
+        for coach in COACH_NAMES[:coaches]:
+            html.append('<tr><td colspan="2"><table width="100%">')
+            html.append(f'<tr height="24" bgcolor="#ffff66"><td colspan="2">'
+                        f'<a class="maintext" href="#">Coach: {coach}</a></td></tr>')
+            for slot in range(slots_per_day):
+                start = 8 * 60 + slot * 20
+                end = start + 20
+                time_text = f"{start // 60:02d}:{start % 60:02d}-{end // 60:02d}:{end % 60:02d}"
+                status = '<input type="checkbox" name="book">' if rng.random() < availability else 'Booked'
+                html.append(f'<tr><td class="tdborder">{time_text}</td><td class="tdborder">{status}</td></tr>')
+            html.append('</table></td></tr>')
+        html.append('</table></td>')
+    html.append('</tr></table></body></html>')
+    return "\n".join(html).encode()
+
+
+def generate_alerts(chats: int, coaches: int, alerts_per_chat: int = 2, seed: int = 0) -> List[Tuple]:
+    """Alert rows shaped like database.get_all_alerts(): (id, chat_id, coach, days, time_range, calendar_id)."""
+    rng = random.Random(seed)
+    calendar_id = get_calendar().id
+    alerts = []
+    for chat_id in range(1, chats + 1):
+        for _ in range(alerts_per_chat):
+            start = rng.randrange(8 * 60, 20 * 60, 30)
+            end = min(start + rng.choice([60, 120, 180]), 23 * 60)
+            days = ",".join(sorted(rng.sample(DAY_NAMES[:5], rng.randint(1, 3))))
+            alerts.append((len(alerts) + 1, chat_id, rng.choice(COACH_NAMES[:coaches]), days,
+                           f"{start // 60:02d}:{start % 60:02d}-{end // 60:02d}:{end % 60:02d}", calendar_id))
+    return alerts
+
+
+# --- Local Stand-In for the Website ---
+
+class CalendarSite:
+    """Serves a cookie page and one calendar page per 'd' value on 127.0.0.1."""
+
+    def __init__(self, pages: Dict[int, bytes]):
+        self.pages = pages
+        self.requests = 0
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                site.requests += 1
+                url = urlparse(self.path)
+                headers = {}
+                if url.path.endswith("index.asp"):
+                    body = b"<html>welcome</html>"
+                    headers["Set-Cookie"] = "ASPSESSIONID=bench; path=/"
+                elif "ASPSESSIONID" not in (self.headers.get("Cookie") or ""):
+                    self.send_response(403)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                else:
+                    d_value = int(parse_qs(url.query).get("d", ["0"])[0])
+                    body = site.pages.get(d_value, b"<html></html>")
+                self.send_response(200)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.base = f"http://127.0.0.1:{self._server.server_address[1]}"
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self._server.shutdown()
+
+
+# --- Measurement ---
+
+def clear_table(table: str):
+    with db.get_connection() as conn:
+        conn.execute(f"DELETE FROM {table}")
+
+
+def measure(func: Callable[[], int], repeat: int) -> Dict[str, float]:
+    """Runs `func` (which returns how many items it processed) and reports latency and throughput."""
+    timings, items = [], 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        items = func()
+        timings.append(time.perf_counter() - start)
+    median = statistics.median(timings)
+    return {"ms": round(median * 1000, 3), "items": items,
+            "items_per_s": round(items / median, 1) if median else 0.0}
+
+
+async def measure_async(func: Callable, repeat: int) -> Dict[str, float]:
+    timings, items = [], 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        items = await func()
+        timings.append(time.perf_counter() - start)
+    median = statistics.median(timings)
+    return {"ms": round(median * 1000, 3), "items": items,
+            "items_per_s": round(items / median, 1) if median else 0.0}
+
+
+async def run_benchmark(args) -> Dict[str, Dict[str, float]]:
+    week_start = date.today() - timedelta(days=date.today().weekday())
+    first_d = scraper.d_value_for(date.today())
+    pages = {first_d + 7 * week: generate_calendar_html(week_start + timedelta(weeks=week), args.coaches,
+                                                        args.slots, seed=week)
+             for week in range(args.weeks)}
+    results = {}
+
+    # Reference: library work only, the yardstick the other stages are compared with.
+    results["reference"] = measure(
+        lambda: sum(len(BeautifulSoup(page, "html.parser").find_all("tr")) for page in pages.values()),
+        args.repeat)
+
+    # Parse: every engine over every week page.
+    for engine in parsers.PARSER_ENGINES:
+        results[f"parse_{engine}"] = measure(
+            lambda: sum(len(parsers.parse(page, engine)) for page in pages.values()), args.repeat)
+
+    # Fetch: the real scraper against the local site, first with a cold page cache, then unchanged.
+    site = CalendarSite(pages)
+    calendar = get_calendar()._replace(calendar_url=f"{site.base}/calendar/calendar_public.asp?c=SWP&v=9",
+                                       cookie_url=f"{site.base}/index.asp")
+    try:
+        async def fetch_cold():
+            await db.run_async(clear_table, "page_state")
+            return len((await scraper.fetch_schedule(args.weeks, calendar)).schedule)
+
+        async def fetch_unchanged():
+            return len((await scraper.fetch_schedule(args.weeks, calendar)).schedule)
+
+        results["fetch_cold"] = await measure_async(fetch_cold, args.repeat)
+        results["fetch_unchanged"] = await measure_async(fetch_unchanged, args.repeat)
+    finally:
+        await scraper.close_session()
+        site.close()
+
+    schedule = scraper.merge_schedules([parsers.parse(page) for page in pages.values()])
+    available = [slot for slot in schedule if slot.available]
+    clear_table("alerts")
+    for _, chat_id, coach, days, time_range, calendar_id in generate_alerts(args.chats, args.coaches):
+        db.add_alert(chat_id, coach, days, time_range, calendar_id)
+
+    # Match: the indexed candidate query for every available slot.
+    matches: List[Tuple] = []
+
+    def match():
+        matches[:] = db.get_matching_alerts(
+            [(slot.coach, slot_day_mask(slot.day), slot.start_minute) for slot in available], calendar.id)
+        return len(matches)
+
+    results["match"] = measure(match, args.repeat)
+
+    # Dedup: one batch lookup and one batch insert for every candidate pair.
+    candidates = list({(alert[1], available[index].key) for index, alert in matches})
+
+    def dedup():
+        clear_table("sent_notifications")
+        unsent = db.get_unsent_notifications(candidates)
+        db.add_sent_notifications((chat_id, key, None) for chat_id, key in unsent)
+        return len(candidates)
+
+    results["dedup"] = measure(dedup, args.repeat)
+
+    # Dispatch: queue one message per chat through the dispatcher into a recording fake bot.
+    # Rate limits are lifted so this measures our own overhead, not Telegram's.
+    chats = sorted({chat_id for chat_id, _ in candidates})
+
+    async def dispatch():
+        bot = FakeBot()
+        dispatcher = NotificationDispatcher(bot, global_rate=1e9, per_chat_rate=1e9)
+        sent = await dispatcher.dispatch([Notification(chat_id, "benchmark") for chat_id in chats])
+        await dispatcher.close()
+        return sum(notification.sent for notification in sent)
+
+    results["dispatch"] = await measure_async(dispatch, args.repeat)
+    return results
+
+
+def relative(results: Dict[str, Dict[str, float]], stage: str) -> float:
+    """A stage's time as a multiple of the reference stage of the same run."""
+    return results[stage]["ms"] / results["reference"]["ms"]
+
+
+def compare(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]],
+            tolerance: float) -> List[str]:
+    """
+    Returns a description of every stage whose time, relative to the reference stage, grew
+    by more than `tolerance` since the baseline.
+    """
+    regressions = []
+    for stage, numbers in results.items():
+        if stage == "reference" or stage not in baseline:
+            continue
+        now, then = relative(results, stage), relative(baseline, stage)
+        if now > then * (1 + tolerance):
+            regressions.append(f"{stage}: {now:.2f}x the reference vs {then:.2f}x in the baseline "
+                               f"({numbers['ms']} ms)")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark parse, fetch, match, dedup and dispatch.")
+    parser.add_argument("--coaches", type=int, default=6)
+    parser.add_argument("--weeks", type=int, default=4)
+    parser.add_argument("--slots", type=int, default=30, help="slots per coach per day")
+    parser.add_argument("--chats", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--tolerance", type=float, default=0.5, help="allowed slowdown, 0.5 = 50%%")
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args()
+
+    params = {name: getattr(args, name) for name in ("coaches", "weeks", "slots", "chats")}
+    results = asyncio.run(run_benchmark(args))
+    print(f"{'stage':<18}{'median ms':>12}{'items':>10}{'items/s':>14}{'x ref':>8}")
+    for stage, numbers in results.items():
+        print(f"{stage:<18}{numbers['ms']:>12}{numbers['items']:>10}{numbers['items_per_s']:>14}"
+              f"{relative(results, stage):>8.2f}")
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({"params": params, "stages": results}, f, indent=2)
+        print(f"Baseline written to {args.baseline}")
+        return
+
+    if not os.path.exists(args.baseline):
+        print("No baseline found; run with --update-baseline to create one.")
+        return
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline["params"] != params:
+        print(f"Baseline was recorded with {baseline['params']}; not comparing against {params}.")
+        return
+    if "reference" not in baseline["stages"]:
+        print("Baseline has no reference stage; run with --update-baseline to record a new one.")
+        return
+    regressions = compare(results, baseline["stages"], args.tolerance)
+    if regressions:
+        print("❌ Regressions against baseline:\n  " + "\n  ".join(regressions))
+        sys.exit(1)
+    print("✅ No regressions against baseline.")
+
+
+if __name__ == "__main__":
+    main()
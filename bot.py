@@ -1,8 +1,14 @@
 # bot.py
 
+import json
 import logging
+import os
 import re
+import secrets
+import time
+from typing import List, Tuple
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.helpers import escape_markdown
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -10,21 +16,38 @@ from telegram.ext import (
     ConversationHandler,
     MessageHandler,
     CallbackQueryHandler,
+    TypeHandler,
     filters,
 )
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
 import database as db
 import scraper
-from config import TELEGRAM_TOKEN
-from scheduler import check_and_notify_all_users  # Updated import
+import worker
+from calendars import all_calendars, get_calendar
+from coach_directory import coach_directory
+from cluster import Cluster
+from config import (
+    TELEGRAM_TOKEN, COMPACTION_HOUR_UTC, ADMIN_CHAT_IDS, METRICS_HOST, METRICS_PORT, MAX_MESSAGE_LENGTH,
+    RUN_MODE, OUTBOX_POLL_SECONDS, UPDATE_MODE, WEBHOOK_URL, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH,
+    WEBHOOK_SECRET_TOKEN, WEBHOOK_MAX_CONNECTIONS, CONCURRENT_UPDATES, UPDATE_RECORD_DIR, CLUSTER_SHARDS,
+    COACH_DIRECTORY_RELOAD_SECONDS,
+)
+from metrics import metrics, start_metrics_server, stop_metrics_server
+from polling import calendar_pollers
+from schedule_cache import schedule_caches
+from scheduler import (
+    check_and_notify_all_users, close_dispatchers, compact_notification_history, deliver_outbox, notify_new_alert,
+)
 
 # Enable logging
 logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+# The outbox and new-alert jobs run every few seconds; APScheduler would log each run.
+logging.getLogger("apscheduler.executors.default").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 # States for ConversationHandler
-COACH, DAYS, START_TIME, END_TIME = range(4)
+CALENDAR, COACH, DAYS, START_TIME, END_TIME = range(5)
 WEEKDAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday"]
 
 
@@ -77,7 +100,7 @@ async def about(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         "--- About This Bot ---\n\n"
         "This bot helps you find available private fencing lessons by automatically checking the public calendar.\n\n"
         "1. Create an alert for your preferred coach, days, and time range.\n"
-        "2. The bot checks the schedule every hour (and once immediately after you create an alert).\n"
+        "2. The bot checks the schedule regularly, more often while it is changing (and once immediately after you create an alert).\n"
         "3. If a class opens up that matches your criteria, you'll get a message instantly!"
     )
     if update.callback_query:
@@ -94,32 +117,76 @@ async def new_alert_start(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     if query:
         await query.answer()
 
-    coaches = scraper.get_all_coaches()
+    calendars = all_calendars()
+    if len(calendars) == 1:
+        return await show_coaches(query, context, calendars[0].id)
+
+    # Buttons carry list positions: Telegram limits callback data to 64 bytes.
+    keyboard = [[InlineKeyboardButton(calendar.name, callback_data=f"calendar_{index}")]
+                for index, calendar in enumerate(calendars)]
+    keyboard.append([InlineKeyboardButton("⬅️ Cancel", callback_data="cancel_action")])
+    text = "Let's set up a new alert. First, please choose the club:"
+    if query:
+        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+    return CALENDAR
+
+
+async def received_calendar_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+    calendars = all_calendars()
+    index = int(query.data.split('_', 1)[1])
+    if not 0 <= index < len(calendars):  # A keyboard from before the calendars were reconfigured
+        return await stale_menu(query, context)
+    return await show_coaches(query, context, calendars[index].id)
+
+
+async def stale_menu(query, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Ends alert creation when a button no longer matches what it was built from, e.g. after a restart."""
+    logger.info(f"Ignoring an out-of-date '{query.data}' button.")
+    context.user_data.clear()
+    await query.edit_message_text("That menu is out of date. Please start again.", reply_markup=InlineKeyboardMarkup(
+        [[InlineKeyboardButton("⬅️ Back to Main Menu", callback_data="main_start")]]))
+    return ConversationHandler.END
+
+
+async def show_coaches(query, context: ContextTypes.DEFAULT_TYPE, calendar_id: str) -> int:
+    context.user_data['calendar_id'] = calendar_id
+    coaches = scraper.get_all_coaches(calendar_id)
     if not coaches:
-        logger.warning("Could not start new alert creation because coach list is empty.")
-        message = "Sorry, I couldn't fetch the list of coaches right now. This could be a temporary issue with the website. Please try again later."
+        logger.warning(f"Could not start new alert creation because the coach list of '{calendar_id}' is empty.")
+        message = "Sorry, I don't know any coaches at this club yet. Please try again in a few minutes, once its calendar has been checked."
         if query:
             await query.edit_message_text(message, reply_markup=InlineKeyboardMarkup(
                 [[InlineKeyboardButton("⬅️ Back to Main Menu", callback_data="main_start")]]))
         return ConversationHandler.END
 
-    keyboard = [[InlineKeyboardButton(coach, callback_data=f"coach_{coach}")] for coach in coaches]
+    # Coach names come from the site and may be long, so the buttons carry list positions.
+    context.user_data['coaches'] = coaches
+    keyboard = [[InlineKeyboardButton(coach, callback_data=f"coach_{index}")] for index, coach in enumerate(coaches)]
     keyboard.append([InlineKeyboardButton("⬅️ Cancel", callback_data="cancel_action")])
-    text = "Let's set up a new alert. First, please choose your preferred coach:"
+    if len(all_calendars()) == 1:
+        text = "Let's set up a new alert. First, please choose your preferred coach:"
+    else:
+        text = f"Now, please choose your preferred coach at **{escape_markdown(get_calendar(calendar_id).name)}**:"
     if query:
-        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
     return COACH
 
 
 async def received_coach_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    coach_name = query.data.split('_', 1)[1]
+    coaches = context.user_data.get('coaches', [])
+    index = int(query.data.split('_', 1)[1])
+    if not 0 <= index < len(coaches):  # The coach list is gone, e.g. the bot restarted since it was shown
+        return await stale_menu(query, context)
+    coach_name = coaches[index]
     context.user_data['coach'] = coach_name
     context.user_data['days'] = set()
     keyboard = create_days_keyboard(context.user_data['days'])
     await query.edit_message_text(
-        text=f"Great, you've selected **{coach_name}**.\n\nNow, please select your preferred days.",
+        text=f"Great, you've selected **{escape_markdown(coach_name)}**.\n\nNow, please select your preferred days.",
         reply_markup=keyboard, parse_mode='Markdown'
     )
     return DAYS
@@ -173,12 +240,15 @@ async def received_end_time(update: Update, context: ContextTypes.DEFAULT_TYPE)
     time_range = f"{start_time}-{end_time}"
     coach = context.user_data['coach']
     days = ",".join(sorted(list(context.user_data['days'])))
+    calendar = get_calendar(context.user_data.get('calendar_id'))
 
-    db.add_alert(update.message.chat_id, coach, days, time_range)
+    alert_id = await db.run_async(db.add_alert, update.message.chat_id, coach, days, time_range, calendar.id)
 
+    club_line = f"  **Club:** {escape_markdown(calendar.name)}\n" if len(all_calendars()) > 1 else ""
     await update.message.reply_text(
         f"✅ **Alert Created!**\n\n"
-        f"  **Coach:** {coach}\n"
+        f"{club_line}"
+        f"  **Coach:** {escape_markdown(coach)}\n"
         f"  **Days:** {days}\n"
         f"  **Time Range:** {time_range}\n\n"
         "I'm performing an initial check now. If any classes match your criteria, you'll get a separate notification message shortly.",
@@ -187,10 +257,10 @@ async def received_end_time(update: Update, context: ContextTypes.DEFAULT_TYPE)
     )
 
     # --- NEW FEATURE ---
-    # Trigger an immediate, non-blocking check for all users.
-    context.application.create_task(
-        check_and_notify_all_users(context.bot, triggered_by=f"new alert from user {update.effective_chat.id}")
-    )
+    # Trigger an immediate, non-blocking check of just this alert against the cached schedule.
+    # In a split deployment the worker notices the new alert and runs this check itself.
+    if RUN_MODE != "bot":
+        context.application.create_task(notify_new_alert(context.bot, alert_id))
 
     context.user_data.clear()
     return ConversationHandler.END
@@ -198,17 +268,20 @@ async def received_end_time(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 async def my_alerts(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.effective_chat.id
-    alerts = db.get_user_alerts(chat_id)
+    alerts = await db.run_async(db.get_user_alerts, chat_id)
     text = "Your active alerts:\n"
     keyboard_buttons = []
     if not alerts:
         text = "You have no active alerts."
     else:
+        multiple_calendars = len(all_calendars()) > 1
         for alert in alerts:
-            alert_id, coach, days, time_range = alert
+            alert_id, coach, days, time_range, calendar_id = alert
             day_parts = days.split(',')
             short_days = " ".join([day[:2] for day in day_parts])
             button_text = f"❌ {coach} | {short_days} | {time_range}"
+            if multiple_calendars:
+                button_text = f"❌ {calendar_id} | {coach} | {short_days} | {time_range}"
             keyboard_buttons.append([InlineKeyboardButton(button_text, callback_data=f"delete_{alert_id}")])
 
     keyboard_buttons.append([InlineKeyboardButton("⬅️ Back to Main Menu", callback_data="main_start")])
@@ -224,11 +297,41 @@ async def delete_alert_callback(update: Update, context: ContextTypes.DEFAULT_TY
     query = update.callback_query
     await query.answer()
     alert_id = int(query.data.split('_')[1])
-    db.delete_alert(alert_id)
+    await db.run_async(db.delete_alert, alert_id)
     await query.answer(text="Alert deleted!", show_alert=True)
     await my_alerts(update, context)
 
 
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Admin only: counters and timings since startup, plus database and cache state."""
+    if update.effective_chat.id not in ADMIN_CHAT_IDS:
+        logger.warning(f"Ignoring /stats from non-admin chat {update.effective_chat.id}.")
+        return
+
+    table_stats = await db.run_async(db.get_table_stats)
+    outbox_stats = await db.run_async(db.get_outbox_stats)
+    lines = [f"Uptime: {int(time.time() - metrics.started_at) // 60} min"]
+    for calendar_id, cache in schedule_caches.items():
+        snapshot = cache.snapshot
+        schedule_text = "none yet" if snapshot is None else f"{len(snapshot.schedule)} slots, {int(snapshot.age)}s old"
+        if cache.last_refresh_failed:
+            schedule_text += " (last refresh failed)"
+        lines.append(f"Schedule ({calendar_id}): {schedule_text}")
+    lines += [
+        "Database: " + ", ".join(f"{name} {value}" for name, value in table_stats.items()),
+        "Outbox: " + (", ".join(f"{status} {count}" for status, count in outbox_stats.items()) or "empty"),
+        f"Alerts evaluated: {metrics.counter('alerts_evaluated_total'):g}",
+    ]
+    if CLUSTER_SHARDS:
+        lines.append("Cluster: " + cluster_summary(await db.run_async(db.get_leases)))
+    lines.append("")
+    lines.extend(metrics.summary() or ["No checks have run yet."])
+    text = "\n".join(lines)
+    if len(text) > MAX_MESSAGE_LENGTH:
+        text = text[:MAX_MESSAGE_LENGTH - 1] + "…"
+    await update.message.reply_text(text)
+
+
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
@@ -237,12 +340,57 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     return ConversationHandler.END
 
 
+async def observe_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Runs before the real handlers: counts updates and, if configured, records them for replay."""
+    kind = "callback_query" if update.callback_query else "message" if update.message else "other"
+    metrics.inc("updates_total", kind=kind)
+    if UPDATE_RECORD_DIR:
+        path = os.path.join(UPDATE_RECORD_DIR, f"{update.update_id}.json")
+        with open(path, "w") as f:
+            json.dump(update.to_dict(), f)
+
+
+def cluster_summary(leases: List[Tuple]) -> str:
+    """'leader a; a holds 0,1,2,3; b holds 4,5,6,7' from the lease rows."""
+    now = time.time()
+    live = [(name, holder) for name, holder, expires_at, _ in leases if holder and expires_at >= now]
+    leader = next((holder for name, holder in live if name == "leader"), "none")
+    shards = {}
+    for name, holder in live:
+        if name.startswith("shard:"):
+            shards.setdefault(holder, []).append(int(name.split(":")[1]))
+    held = "; ".join(f"{holder} holds {','.join(map(str, sorted(owned)))}" for holder, owned in sorted(shards.items()))
+    return f"leader {leader}" + (f"; {held}" if held else "")
+
+
+async def post_shutdown(application: Application) -> None:
+    """Stops the notification workers and releases the HTTP session, database connection and metrics endpoint."""
+    cluster = application.bot_data.get("cluster")
+    if cluster is not None:
+        await cluster.stop()
+    await close_dispatchers()
+    await scraper.close_session()
+    db.close_database()
+    stop_metrics_server()
+
+
 def main() -> None:
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    if RUN_MODE == "worker":
+        worker.main()
+        return
+
+    application = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .post_shutdown(post_shutdown)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .build()
+    )
     conv_handler = ConversationHandler(
         entry_points=[CallbackQueryHandler(new_alert_start, pattern='^main_new_alert$')],
         states={
-            COACH: [CallbackQueryHandler(received_coach_callback, pattern='^coach_')],
+            CALENDAR: [CallbackQueryHandler(received_calendar_callback, pattern=r'^calendar_\d+$')],
+            COACH: [CallbackQueryHandler(received_coach_callback, pattern=r'^coach_\d+$')],
             DAYS: [CallbackQueryHandler(received_day_callback, pattern='^day_')],
             START_TIME: [MessageHandler(filters.TEXT & ~filters.COMMAND, received_start_time)],
             END_TIME: [MessageHandler(filters.TEXT & ~filters.COMMAND, received_end_time)],
@@ -250,22 +398,59 @@ def main() -> None:
         fallbacks=[CallbackQueryHandler(cancel, pattern='^cancel_action$')],
     )
 
+    if UPDATE_RECORD_DIR:
+        os.makedirs(UPDATE_RECORD_DIR, exist_ok=True)
+    application.add_handler(TypeHandler(Update, observe_update), group=-1)
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CallbackQueryHandler(start, pattern='^main_start$'))
     application.add_handler(CallbackQueryHandler(about, pattern='^main_about$'))
     application.add_handler(CallbackQueryHandler(my_alerts, pattern='^main_my_alerts$'))
     application.add_handler(CommandHandler("about", about))
     application.add_handler(CommandHandler("myalerts", my_alerts))
+    application.add_handler(CommandHandler("stats", stats))
     application.add_handler(conv_handler)
     application.add_handler(CallbackQueryHandler(delete_alert_callback, pattern='^delete_'))
 
     scheduler = AsyncIOScheduler(timezone="UTC")
-    # Updated scheduler to use the new function name
-    scheduler.add_job(check_and_notify_all_users, 'interval', hours=1, args=[application.bot, "hourly schedule"])
+    if RUN_MODE == "bot":
+        # The worker process scrapes and matches; we only deliver what it queued.
+        scheduler.add_job(deliver_outbox, 'interval', seconds=OUTBOX_POLL_SECONDS, args=[application.bot],
+                          max_instances=1, coalesce=True)
+        # The worker keeps the coach directory up to date in the database.
+        scheduler.add_job(coach_directory.reload, 'interval', seconds=COACH_DIRECTORY_RELOAD_SECONDS)
+    elif CLUSTER_SHARDS:
+        # The leader scrapes; every instance notifies the chats in its shards (see cluster.py).
+        cluster = application.bot_data["cluster"] = Cluster(application.bot, scheduler)
+        cluster.start()
+        scheduler.add_job(cluster.leader_only(compact_notification_history), 'cron', hour=COMPACTION_HOUR_UTC)
+        scheduler.add_job(coach_directory.reload, 'interval', seconds=COACH_DIRECTORY_RELOAD_SECONDS)
+    else:
+        # Scheduled checks always fetch a fresh calendar (max_age=0); each calendar's cadence adapts
+        # to how often it changes.
+        for poller in calendar_pollers(scheduler, lambda calendar: check_and_notify_all_users(
+                application.bot, "scheduled poll", max_age=0, calendar_id=calendar.id)):
+            poller.start()
+        scheduler.add_job(compact_notification_history, 'cron', hour=COMPACTION_HOUR_UTC)
     scheduler.start()
-    logger.info("Scheduler started. Will run checks every hour.")
-
-    application.run_polling()
+    logger.info(f"Scheduler started ({RUN_MODE} mode).")
+    start_metrics_server(METRICS_HOST, METRICS_PORT)
+
+    if UPDATE_MODE == "webhook":
+        if not WEBHOOK_URL:
+            raise SystemExit("UPDATE_MODE=webhook needs WEBHOOK_URL, the public https address Telegram should call.")
+        # Telegram echoes the secret back in a header on every request; anything else is refused with 403.
+        secret_token = WEBHOOK_SECRET_TOKEN or secrets.token_urlsafe(32)
+        logger.info(f"Serving webhook on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH} for {WEBHOOK_URL}")
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL,
+            secret_token=secret_token,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+    else:
+        application.run_polling()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,69 @@
+# calendars.py
+
+import json
+import logging
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from config import (
+    CALENDARS, CALENDARS_FILE, DEFAULT_CALENDAR_ID, SCHEDULE_WEEKS_AHEAD, PARSER_ENGINE, POLL_MIN_SECONDS,
+    POLL_MAX_SECONDS,
+)
+from parsers import PARSER_ENGINES
+
+# Get the logger
+logger = logging.getLogger(__name__)
+
+
+class Calendar(NamedTuple):
+    """One club's booking calendar and how we poll it."""
+    id: str
+    name: str
+    calendar_url: str  # Without the 'd' parameter, which selects the week
+    cookie_url: str  # Page that hands out the session cookie the calendar requires
+    reference_d_value: int  # The 'd' value of reference_date
+    reference_date: str  # YYYY-MM-DD
+    weeks_ahead: int = SCHEDULE_WEEKS_AHEAD
+    parser_engine: str = PARSER_ENGINE
+    poll_min_seconds: float = POLL_MIN_SECONDS
+    poll_max_seconds: float = POLL_MAX_SECONDS
+    coaches: Tuple[str, ...] = ()  # Offered when creating an alert until the coach directory has some
+
+
+def load_calendars(entries: Optional[List[Dict]] = None, path: Optional[str] = CALENDARS_FILE) -> Dict[str, Calendar]:
+    """
+    Builds the configured calendars, keyed by id, from `path` (a JSON list) if given,
+    otherwise from `entries`. Raises ValueError on an invalid configuration.
+    """
+    if entries is None:
+        if path:
+            with open(path) as f:
+                entries = json.load(f)
+        else:
+            entries = CALENDARS
+    calendars: Dict[str, Calendar] = {}
+    for entry in entries:
+        try:
+            calendar = Calendar(**{**entry, "coaches": tuple(entry.get("coaches", ()))})
+        except TypeError as e:
+            raise ValueError(f"Invalid calendar configuration {entry}: {e}") from None
+        if calendar.id in calendars:
+            raise ValueError(f"Calendar id '{calendar.id}' is configured twice.")
+        if calendar.parser_engine not in PARSER_ENGINES:
+            raise ValueError(f"Calendar '{calendar.id}' uses unknown parser engine '{calendar.parser_engine}'.")
+        calendars[calendar.id] = calendar
+    if DEFAULT_CALENDAR_ID not in calendars:
+        raise ValueError(f"DEFAULT_CALENDAR_ID '{DEFAULT_CALENDAR_ID}' is not one of the configured calendars.")
+    return calendars
+
+
+_calendars = load_calendars()
+
+
+def all_calendars() -> List[Calendar]:
+    """Every configured calendar, in configuration order."""
+    return list(_calendars.values())
+
+
+def get_calendar(calendar_id: Optional[str] = None) -> Calendar:
+    """The calendar with this id (the default calendar if None). Raises KeyError for unknown ids."""
+    return _calendars[calendar_id or DEFAULT_CALENDAR_ID]
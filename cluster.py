@@ -0,0 +1,172 @@
+# cluster.py
+#
+# Multi-instance mode (CLUSTER_SHARDS > 0). Any number of processes share one database
+# file; they coordinate only through lease rows in it:
+#
+#   - The 'leader' lease. Its holder runs the adaptive pollers, scrapes the calendars and
+#     publishes every changed schedule of each, together with the slots that opened in it. It also
+#     runs the once-per-deployment jobs (compaction, watching for new alerts). If it dies,
+#     another instance takes the lease once it expires and carries on.
+#   - One 'shard:<n>' lease per shard of chats (by chat_id hash). Each instance holds an
+#     even share of them and checks every published schedule for the chats in its shards.
+#     A shard's cursor records the last schedule it was checked against, so an instance
+#     that takes over a shard continues where the previous holder stopped.
+#
+# Try it locally with a few workers on one database file:
+#
+#   CLUSTER_SHARDS=8 INSTANCE_ID=a RUN_MODE=worker python bot.py
+#   CLUSTER_SHARDS=8 INSTANCE_ID=b RUN_MODE=worker python bot.py
+#   RUN_MODE=bot python bot.py   # delivers what the workers queue
+#
+# Several RUN_MODE=all instances also work, but Telegram only lets one of them long-poll
+# for updates; run them in webhook mode behind a load balancer instead.
+
+import asyncio
+import functools
+import logging
+import zlib
+from typing import Awaitable, Callable, List, Optional
+
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from telegram import Bot
+
+import database as db
+import scraper
+from calendars import Calendar, get_calendar
+from config import (
+    CLUSTER_SHARDS, INSTANCE_ID, CLUSTER_LEASE_SECONDS, CLUSTER_TICK_SECONDS, PUBLISHED_SNAPSHOTS_KEPT,
+)
+from metrics import metrics
+from polling import calendar_pollers
+from schedule_cache import schedule_caches
+from scheduler import CheckResult, check_published_snapshot
+
+# Get the logger
+logger = logging.getLogger(__name__)
+
+LEADER_LEASE = "leader"
+
+
+def shard_of(chat_id: int, shards: int = CLUSTER_SHARDS) -> int:
+    """The shard a chat belongs to. Stable across processes and restarts."""
+    return zlib.crc32(str(chat_id).encode()) % shards
+
+
+class Cluster:
+    """One instance's view of the cluster: whether it leads, and which shards it holds."""
+
+    def __init__(self, bot: Optional[Bot], scheduler: AsyncIOScheduler, instance_id: str = INSTANCE_ID,
+                 shards: int = CLUSTER_SHARDS, lease_seconds: float = CLUSTER_LEASE_SECONDS,
+                 tick_seconds: float = CLUSTER_TICK_SECONDS):
+        self.bot = bot
+        self.scheduler = scheduler
+        self.instance_id = instance_id
+        self.shards = shards
+        self.lease_seconds = lease_seconds
+        self.tick_seconds = tick_seconds
+        self.is_leader = False
+        self.owned_shards: List[int] = []
+        # Scheduled polls always fetch a fresh calendar (max_age=0), like the single-instance bot.
+        self.pollers = calendar_pollers(scheduler, self.publish)
+        self._check_task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Joins the cluster. Leases are renewed, and published schedules checked, every tick."""
+        # Only the leader scrapes; the others take the schedule from the latest published one.
+        for calendar_id, cache in schedule_caches.items():
+            cache.set_source(functools.partial(self.fetch_schedule, calendar_id))
+        self.scheduler.add_job(self.tick, 'interval', seconds=self.tick_seconds, max_instances=1, coalesce=True)
+        logger.info(f"Joining the cluster as '{self.instance_id}' ({self.shards} shards).")
+
+    async def stop(self):
+        """Leaves the cluster, releasing every lease so other instances take over right away."""
+        for poller in self.pollers:
+            poller.stop()
+        if self._check_task is not None:
+            self._check_task.cancel()
+        await db.run_async(db.release_leases, self.instance_id)
+        self.is_leader = False
+        self.owned_shards = []
+
+    def leader_only(self, job: Callable[[], Awaitable]) -> Callable[[], Awaitable]:
+        """Wraps a scheduled job so that only the current leader runs it."""
+        async def run():
+            if self.is_leader:
+                return await job()
+        return run
+
+    def owns_chat(self, chat_id: int) -> bool:
+        return shard_of(chat_id, self.shards) in self.owned_shards
+
+    async def tick(self):
+        leader = await db.run_async(db.acquire_lease, LEADER_LEASE, self.instance_id, self.lease_seconds)
+        if leader and not self.is_leader:
+            logger.info("This instance is now the leader; it will scrape and publish the schedules.")
+            metrics.inc("cluster_leader_changes_total")
+            for poller in self.pollers:
+                poller.start()
+        elif self.is_leader and not leader:
+            logger.warning("This instance lost the leader lease; another instance scrapes now.")
+            for poller in self.pollers:
+                poller.stop()
+        self.is_leader = leader
+
+        # Shards being checked right now are not given away until that check is done.
+        checking = self._check_task is not None and not self._check_task.done()
+        owned = await db.run_async(db.claim_shards, self.instance_id, self.shards, self.lease_seconds,
+                                   not checking)
+        if owned != self.owned_shards:
+            logger.info(f"This instance now holds shards {owned}.")
+            self.owned_shards = owned
+        if not checking and owned:
+            self._check_task = asyncio.create_task(self.check_published())
+
+    async def check_published(self):
+        """Checks every schedule published since each held shard's cursor, oldest first."""
+        try:
+            cursors = await db.run_async(db.get_shard_cursors, self.instance_id, self.owned_shards)
+            if not cursors:
+                return
+            snapshots = await db.run_async(db.get_published_snapshots, min(cursors.values()))
+            latest = {}
+            for snapshot in snapshots:
+                # Shards taken over from a crashed instance may still be behind the others.
+                behind = {shard for shard, position in cursors.items() if position < snapshot.id}
+                await check_published_snapshot(
+                    self.bot, snapshot, lambda chat_id: shard_of(chat_id, self.shards) in behind)
+                await db.run_async(db.advance_shard_cursors, self.instance_id, behind, snapshot.id)
+                metrics.inc("cluster_snapshots_checked_total")
+                latest[snapshot.calendar_id] = snapshot
+            if not self.is_leader:
+                for calendar_id, snapshot in latest.items():
+                    if calendar_id in schedule_caches:
+                        schedule_caches[calendar_id].install(snapshot.schedule)
+        except Exception as e:
+            logger.error(f"Checking the published schedules failed: {e}")
+
+    # --- Leader ---
+
+    async def publish(self, calendar: Calendar) -> CheckResult:
+        """The leader's scheduled poll of one calendar: scrapes, and publishes the schedule if it changed."""
+        cache = schedule_caches[calendar.id]
+        snapshot = await cache.get(max_age=0)
+        if snapshot is None:
+            return CheckResult(failed=True)
+        result = CheckResult(changed=snapshot.changed, failed=cache.last_refresh_failed)
+        if snapshot.changed:
+            snapshot_id = await db.run_async(db.publish_snapshot, snapshot.schedule, snapshot.opened_slots,
+                                             PUBLISHED_SNAPSHOTS_KEPT, calendar.id)
+            metrics.inc("cluster_snapshots_published_total", calendar=calendar.id)
+            logger.info(f"Published schedule {snapshot_id} of '{calendar.id}' "
+                        f"with {len(snapshot.opened_slots)} newly opened slots.")
+        return result
+
+    async def fetch_schedule(self, calendar_id: str) -> scraper.ScheduleFetch:
+        """Schedule cache source: the leader scrapes, everyone else reads the latest published schedule."""
+        if self.is_leader:
+            return await scraper.fetch_schedule(calendar=get_calendar(calendar_id))
+        published = await db.run_async(db.get_latest_published_snapshot, calendar_id)
+        if published is None:
+            raise scraper.ScrapeError(f"The leader has not published a schedule of '{calendar_id}' yet.")
+        # Not `changed`: the leader already worked out which slots opened in it.
+        return scraper.ScheduleFetch(published.schedule, False)
@@ -0,0 +1,85 @@
+# coach_directory.py
+#
+# The coaches offered when creating an alert. Every fetched schedule updates the directory
+# (first and last time each coach was seen on each calendar) in memory and, for new coaches
+# and at most once per COACH_DIRECTORY_TOUCH_SECONDS for known ones, in the database.
+# Reading it never touches the network, so the alert flow can start instantly.
+
+import logging
+import sqlite3
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import database as db
+from config import COACH_DIRECTORY_STALE_DAYS, COACH_DIRECTORY_TOUCH_SECONDS
+from metrics import metrics
+from slot import Slot
+
+# Get the logger
+logger = logging.getLogger(__name__)
+
+# What the calendar shows for slots without a named coach
+PLACEHOLDER_COACHES = {"", "Unknown Coach"}
+
+
+class CoachDirectory:
+    """In-memory copy of the coach_directory table, kept up to date from fetched schedules."""
+
+    def __init__(self, stale_days: float = COACH_DIRECTORY_STALE_DAYS,
+                 touch_seconds: float = COACH_DIRECTORY_TOUCH_SECONDS):
+        self.stale_seconds = stale_days * 24 * 60 * 60
+        self.touch_seconds = touch_seconds
+        # calendar_id -> coach name -> (first_seen, last_seen)
+        self._coaches: Dict[str, Dict[str, Tuple[float, float]]] = {}
+        # Last-seen times as stored in the database, to know when a coach is due a write
+        self._stored: Dict[Tuple[str, str], float] = {}
+
+    def load(self, sightings: Iterable[db.CoachSighting]):
+        """Merges rows read from the database, e.g. ones another process wrote."""
+        for sighting in sightings:
+            coaches = self._coaches.setdefault(sighting.calendar_id, {})
+            first_seen, last_seen = coaches.get(sighting.name, (sighting.first_seen, sighting.last_seen))
+            coaches[sighting.name] = (min(first_seen, sighting.first_seen), max(last_seen, sighting.last_seen))
+            key = (sighting.calendar_id, sighting.name)
+            self._stored[key] = max(self._stored.get(key, 0.0), sighting.last_seen)
+
+    async def reload(self):
+        """Scheduled job for processes that do not fetch schedules themselves."""
+        try:
+            self.load(await db.run_async(db.get_coach_directory))
+        except sqlite3.Error as e:
+            logger.warning(f"Could not reload the coach directory: {e}")
+
+    async def observe(self, calendar_id: str, schedule: List[Slot], seen_at: Optional[float] = None):
+        """Records the coaches in a freshly fetched schedule of a calendar."""
+        seen_at = seen_at or time.time()
+        coaches = self._coaches.setdefault(calendar_id, {})
+        new, due = [], []
+        for name in {slot.coach for slot in schedule} - PLACEHOLDER_COACHES:
+            if name not in coaches:
+                new.append(name)
+            elif seen_at - self._stored.get((calendar_id, name), 0.0) >= self.touch_seconds:
+                due.append(name)
+            coaches[name] = (coaches.get(name, (seen_at, seen_at))[0], seen_at)
+        if new:
+            logger.info(f"New coaches on '{calendar_id}': {', '.join(sorted(new))}")
+            metrics.inc("coaches_discovered_total", len(new), calendar=calendar_id)
+        if not new and not due:
+            return
+        try:
+            await db.run_async(db.record_coaches, calendar_id, sorted(new + due), seen_at)
+        except sqlite3.Error as e:
+            logger.warning(f"Could not save the coach directory: {e}")
+            return
+        self._stored.update({(calendar_id, name): seen_at for name in new + due})
+
+    def names(self, calendar_id: str, now: Optional[float] = None) -> List[str]:
+        """The coaches seen on a calendar within the staleness window, sorted. Memory only."""
+        cutoff = (now or time.time()) - self.stale_seconds
+        return sorted(name for name, (_, last_seen) in self._coaches.get(calendar_id, {}).items()
+                      if last_seen >= cutoff)
+
+
+# The process-wide directory, loaded from the database at import like the database module itself
+coach_directory = CoachDirectory()
+coach_directory.load(db.get_coach_directory())
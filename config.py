@@ -2,18 +2,168 @@
 
 from dotenv import load_dotenv
 import os
+import socket
 
 load_dotenv()
 
 # Replace "YOUR_TELEGRAM_BOT_TOKEN" with the token you get from BotFather
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 
+# Path of the SQLite database file.
+DB_NAME = os.getenv("DB_NAME", "fencing_alerts.db")
+# Sent notifications are forgotten once their slot date has passed. Ones whose date
+# could not be read are kept this many days instead.
+NOTIFICATION_RETENTION_DAYS = 30
+# Hour of the day (UTC) when expired notifications are pruned and the database compacted.
+COMPACTION_HOUR_UTC = 4
+
 BASE_CALENDAR_URL = "https://www.fencersnetwork.com/calendar/calendar_public.asp?c=SWP&v=9"
 
 # The initial URL to visit to get a valid session cookie.
 COOKIE_URL = "https://www.swordplayers.com/index.asp"
 
+# HTTP settings for the shared scraper session.
+HTTP_TIMEOUT_SECONDS = 15
+# How long we reuse a session cookie before fetching a fresh one (ASP sessions time out after ~20 min idle).
+COOKIE_MAX_AGE_SECONDS = 15 * 60
+
 # This is the 'd' value for a known date. We'll use this to calculate future dates.
 # d=6477 corresponds to Sep 24, 2025
 REFERENCE_D_VALUE = 6477
-REFERENCE_DATE = "2025-09-24" # YYYY-MM-DD
\ No newline at end of file
+REFERENCE_DATE = "2025-09-24" # YYYY-MM-DD
+
+# How many weeks of the calendar to fetch, starting with the current one.
+SCHEDULE_WEEKS_AHEAD = 4
+# Maximum number of calendar pages fetched at the same time.
+FETCH_CONCURRENCY = 3
+# Worker processes used to parse pages in parallel. 0 parses in a background thread instead,
+# which is faster for this site: sending the parsed slots back from a worker costs more than
+# the lxml parse itself (benchmark fetch_cold: ~178 ms with 0, ~201 ms with 2 workers).
+PARSE_WORKERS = 0
+# Calendar parser engine: "lxml" (fast, compiled XPath) or "bs4" (the original html.parser walk).
+PARSER_ENGINE = "lxml"
+
+# Every fetched calendar page is kept, gzip-compressed and deduplicated, in this directory
+# (see page_archive.py). Set it to an empty string to turn archiving off.
+PAGE_ARCHIVE_DIR = os.getenv("PAGE_ARCHIVE_DIR", "page_archive")
+PAGE_ARCHIVE_RETENTION_DAYS = 30
+PAGE_ARCHIVE_MAX_MB = 200
+# Where schedules come from: "live" fetches the site, "archive" replays archived pages offline.
+SCRAPE_SOURCE = os.getenv("SCRAPE_SOURCE", "live")
+# In archive mode, replay the pages as they were at this time (ISO format, e.g. 2025-09-24T18:00).
+# Defaults to the newest archived fetch.
+SCRAPE_REPLAY_AT = os.getenv("SCRAPE_REPLAY_AT")
+
+# How long a parsed schedule is reused before the site is scraped again.
+SCHEDULE_CACHE_TTL_SECONDS = 5 * 60
+# If the site is down, keep serving the last schedule for up to this long.
+SCHEDULE_CACHE_MAX_STALE_SECONDS = 3 * 60 * 60
+
+# Adaptive polling. The check interval starts at the minimum, grows by the backoff factor
+# after every run without changes (or with an upstream error) and resets on any change.
+POLL_MIN_SECONDS = 5 * 60
+POLL_MAX_SECONDS = 60 * 60
+POLL_BACKOFF_FACTOR = 2
+POLL_JITTER = 0.1  # +/- 10% on every delay
+# Times (UTC) when slots are usually released, as (day or "*", "HH:MM", "HH:MM").
+# We poll at the minimum interval inside these windows and a little before them.
+RELEASE_WINDOWS = []
+RELEASE_WINDOW_LEAD_MINUTES = 15
+
+# Calendars (one per club) to watch. Each has its own session cookie, poll cadence and parser
+# settings, and every alert belongs to one of them; keys left out take the settings above.
+# All calendars share one fetch/parse/match/notify pipeline, so FETCH_CONCURRENCY, PARSE_WORKERS
+# and the Telegram rate limits apply across them. Set CALENDARS_FILE to a JSON file holding a
+# list in the same shape to configure them without editing this file.
+CALENDARS = [
+    {
+        "id": "swp",
+        "name": "Swordplayers",
+        "calendar_url": BASE_CALENDAR_URL,
+        "cookie_url": COOKIE_URL,
+        "reference_d_value": REFERENCE_D_VALUE,
+        "reference_date": REFERENCE_DATE,
+        "coaches": ["Arseni", "David G", "Igor"],  # Until the coach directory has been filled
+    },
+]
+CALENDARS_FILE = os.getenv("CALENDARS_FILE")
+# Alerts created before calendars could be configured belong to this one. Its slots keep
+# the original notification keys; other calendars' keys are prefixed with their id.
+DEFAULT_CALENDAR_ID = "swp"
+
+# Coach directory. Every coach seen in a fetched schedule is remembered per calendar and
+# offered when creating an alert; the calendar's "coaches" list is only used until the first
+# schedule has been fetched. Coaches not seen for this long are dropped.
+COACH_DIRECTORY_STALE_DAYS = 28
+# A coach's last-seen time is written to the database at most this often.
+COACH_DIRECTORY_TOUCH_SECONDS = 60 * 60
+# How often a process that does not fetch schedules itself (the bot in a split deployment,
+# instances other than the cluster leader) reloads the directory from the database.
+COACH_DIRECTORY_RELOAD_SECONDS = 5 * 60
+
+# Notification delivery. Telegram allows about 30 messages per second overall and one per second per chat.
+DISPATCH_CONCURRENCY = 8
+TELEGRAM_GLOBAL_RATE = 25
+TELEGRAM_PER_CHAT_RATE = 1
+# How many times a message that failed with a network error is retried.
+DISPATCH_MAX_RETRIES = 3
+# Telegram rejects messages over 4096 characters; digests are split below this length.
+MAX_MESSAGE_LENGTH = 4000
+
+# How the bot receives updates: "polling" (long polling) or "webhook" (Telegram calls us).
+UPDATE_MODE = os.getenv("UPDATE_MODE", "polling")
+# Webhook mode. Telegram posts updates to WEBHOOK_URL (public https address, e.g. behind a
+# reverse proxy) which must reach the embedded server on WEBHOOK_LISTEN:WEBHOOK_PORT/WEBHOOK_PATH.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+# Requests without this value in X-Telegram-Bot-Api-Secret-Token are rejected. A random one is
+# generated at startup if unset; set it to replay recorded updates against a running bot.
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN")
+# Simultaneous HTTPS connections Telegram may open to the webhook (1-100).
+WEBHOOK_MAX_CONNECTIONS = 40
+# Updates handled at the same time, in either mode. 1 handles them strictly one by one.
+# The alert-creation flow is a ConversationHandler, which python-telegram-bot only supports
+# with updates processed one by one: above 1, two quick taps in one chat can race through
+# its states. Only raise it for load testing (e.g. with replay_updates.py).
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "1"))
+# If set, every incoming update is saved here as JSON, for replay_updates.py.
+UPDATE_RECORD_DIR = os.getenv("UPDATE_RECORD_DIR")
+
+# Process layout. "all" runs everything in one process. For a split deployment, run one
+# process with RUN_MODE=worker (scrapes, matches and queues messages in the database
+# outbox) and one with RUN_MODE=bot (chat UI; delivers the queued messages).
+RUN_MODE = os.getenv("RUN_MODE", "all")
+# How often the bot process looks for queued messages, and how many it takes at a time.
+OUTBOX_POLL_SECONDS = 2
+OUTBOX_BATCH_SIZE = 100
+# A message claimed by a bot process that died before confirming it is sent again after this long.
+OUTBOX_LEASE_SECONDS = 2 * 60
+# Delivery attempts (each with the dispatcher's own retries) before a queued message is given up.
+OUTBOX_MAX_ATTEMPTS = 5
+# Delivered or failed outbox rows are kept this many days for inspection.
+OUTBOX_RETENTION_DAYS = 7
+
+# Multi-instance mode. With CLUSTER_SHARDS > 0, several processes (RUN_MODE all or worker)
+# can share one database file. The leader, elected through a lease row, scrapes and publishes
+# each changed schedule; chats are split into CLUSTER_SHARDS shards by chat_id hash, and every
+# instance checks the published schedules for the shards it holds. Keep the number of shards
+# fixed once set, and above the number of instances you expect to run.
+CLUSTER_SHARDS = int(os.getenv("CLUSTER_SHARDS", "0"))
+# Must be unique per running instance.
+INSTANCE_ID = os.getenv("INSTANCE_ID") or f"{socket.gethostname()}-{os.getpid()}"
+# A lease not renewed for this long is taken over by another instance.
+CLUSTER_LEASE_SECONDS = 30
+# How often leases are renewed and new published schedules are looked for.
+CLUSTER_TICK_SECONDS = 5
+# Published schedules kept, so a shard taken over after a crash can catch up.
+PUBLISHED_SNAPSHOTS_KEPT = 20  # Per calendar
+
+# Metrics. Counters and timings are served at http://METRICS_HOST:METRICS_PORT/metrics
+# (0 turns the endpoint off) and summarised by the /stats command for the admin chats.
+# In a split deployment the worker serves its metrics on METRICS_PORT + 1.
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+# Comma-separated Telegram chat ids allowed to use admin commands such as /stats.
+ADMIN_CHAT_IDS = {int(chat_id) for chat_id in os.getenv("ADMIN_CHAT_IDS", "").split(",") if chat_id.strip()}
@@ -1,98 +1,774 @@
 # database.py
 
+import asyncio
+import functools
+import hashlib
+import json
 import sqlite3
-from typing import List, Tuple
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import date
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple, TypeVar
+
+from config import (
+    DB_NAME, NOTIFICATION_RETENTION_DAYS, OUTBOX_RETENTION_DAYS, DEFAULT_CALENDAR_ID, COACH_DIRECTORY_STALE_DAYS,
+)
+from matcher import day_mask, parse_time_range
+from metrics import metrics
+from slot import Slot
+
+T = TypeVar("T")
+
+# --- Connection Management ---
+# One long-lived connection in WAL mode is shared by the whole process. The lock
+# serializes access to it; the async facade below runs every call on a single
+# dedicated thread so database work never blocks the event loop.
+_conn: Optional[sqlite3.Connection] = None
+_lock = threading.RLock()
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+
+
+def get_connection() -> sqlite3.Connection:
+    """Returns the shared connection, opening and tuning it on first use."""
+    global _conn
+    if _conn is None:
+        _conn = sqlite3.connect(DB_NAME, check_same_thread=False, cached_statements=128)
+        _conn.execute("PRAGMA journal_mode = WAL")
+        _conn.execute("PRAGMA synchronous = NORMAL")  # Safe with WAL; fsync only at checkpoints
+        _conn.execute("PRAGMA busy_timeout = 5000")
+        _conn.execute("PRAGMA temp_store = MEMORY")
+        _conn.execute("PRAGMA cache_size = -8000")  # ~8 MB page cache
+    return _conn
+
+
+@contextmanager
+def _transaction() -> Iterator[sqlite3.Cursor]:
+    """Yields a cursor on the shared connection and commits (or rolls back) when done."""
+    with _lock:
+        conn = get_connection()
+        with conn:
+            yield conn.cursor()
+
+
+def close_database():
+    """Closes the shared connection. It is reopened on next use."""
+    global _conn
+    with _lock:
+        if _conn is not None:
+            _conn.close()
+        _conn = None
+
+
+def _timed(func: Callable[..., T], *args) -> T:
+    # Measured on the database thread, so the time spent queued behind other calls is not included.
+    with metrics.span("db", op=func.__name__):
+        return func(*args)
+
+
+async def run_async(func: Callable[..., T], *args) -> T:
+    """Runs a database function on the database thread and awaits its result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(_timed, func, *args))
 
-DB_NAME = "fencing_alerts.db"
 
 def initialize_database():
     """Creates the tables if they don't exist."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    # Main alerts table
+    with _transaction() as cursor:
+        _create_tables(cursor)
+
+
+def _create_tables(cursor: sqlite3.Cursor):
+    # Coaches that alerts refer to. name_key is the lower-cased name used for matching.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS coaches (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            name_key TEXT NOT NULL UNIQUE
+        );
+    """)
+    # Main alerts table. The text columns are what the user entered and are shown back
+    # to them; coach_id, day_mask and the minute range are what matching runs on.
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS alerts (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             chat_id INTEGER NOT NULL,
             coach_name TEXT NOT NULL,
             days_of_week TEXT NOT NULL,
-            time_range TEXT NOT NULL
+            time_range TEXT NOT NULL,
+            coach_id INTEGER REFERENCES coaches (id),
+            day_mask INTEGER,      -- Bit 0 = Monday ... bit 6 = Sunday
+            start_minute INTEGER,  -- Minutes since midnight; NULL if time_range is malformed
+            end_minute INTEGER,
+            calendar_id TEXT       -- The calendar (club) whose slots the alert watches
         );
     """)
-    # New table to prevent duplicate notifications
+    cursor.execute("PRAGMA table_info(alerts)")
+    if "day_mask" not in {column[1] for column in cursor.fetchall()}:
+        _migrate_alerts(cursor)
+    _add_calendar_column(cursor, "alerts")
+    # Table to prevent duplicate notifications. Keys are stored as a 64-bit hash, and
+    # slot_date lets us forget a notification once its slot is in the past.
+    cursor.execute("PRAGMA table_info(sent_notifications)")
+    if "notification_key" in {column[1] for column in cursor.fetchall()}:
+        _migrate_sent_notifications(cursor)
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS sent_notifications (
+            chat_id INTEGER NOT NULL,
+            key_hash INTEGER NOT NULL,
+            slot_date TEXT,           -- YYYY-MM-DD, NULL if the calendar date could not be read
+            sent_at INTEGER NOT NULL, -- Unix time
+            PRIMARY KEY (chat_id, key_hash)
+        ) WITHOUT ROWID;
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sent_notifications_slot_date ON sent_notifications (slot_date)")
+    # Last fetch of each calendar page, used to skip unchanged pages
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS page_state (
+            url TEXT PRIMARY KEY,
+            content_hash TEXT NOT NULL,
+            etag TEXT,
+            last_modified TEXT,
+            slots TEXT NOT NULL, -- Parsed slots of the page as JSON
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+    # Availability of every slot as of the last check, used to find newly opened slots
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS slot_snapshot (
+            slot_key TEXT PRIMARY KEY,
+            available INTEGER NOT NULL,
+            calendar_id TEXT
+        );
+    """)
+    _add_calendar_column(cursor, "slot_snapshot")
+    # Lookups by user (My Alerts, deletes). Dedup lookups use the sent_notifications primary key.
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_alerts_chat_id ON alerts (chat_id)")
+    # Messages queued by the worker process for the bot process to deliver
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS outbox (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             chat_id INTEGER NOT NULL,
-            notification_key TEXT NOT NULL,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-            UNIQUE(chat_id, notification_key)
+            text TEXT NOT NULL,
+            parse_mode TEXT,
+            priority REAL NOT NULL DEFAULT 0,
+            status TEXT NOT NULL DEFAULT 'pending',  -- pending, delivered or failed
+            attempts INTEGER NOT NULL DEFAULT 0,
+            not_before INTEGER NOT NULL DEFAULT 0,   -- Unix time; used to back off retries
+            claimed_at INTEGER,                      -- Unix time a bot process took it, NULL if free
+            created_at INTEGER NOT NULL,
+            finished_at INTEGER,
+            error TEXT
         );
     """)
-    conn.commit()
-    conn.close()
-
-def add_alert(chat_id: int, coach: str, days: str, time_range: str):
-    """Adds a new alert to the database."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT INTO alerts (chat_id, coach_name, days_of_week, time_range) VALUES (?, ?, ?, ?)",
-        (chat_id, coach, days, time_range)
-    )
-    conn.commit()
-    conn.close()
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox (priority, id) WHERE status = 'pending'")
+    # Candidate lookups by coach and start time; covers the rest of the match condition too.
+    cursor.execute("DROP INDEX IF EXISTS idx_alerts_match")  # Replaced by the calendar-scoped index below
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_alerts_match_calendar "
+                   "ON alerts (calendar_id, coach_id, start_minute, end_minute, day_mask)")
+    # Multi-instance mode: the leader lease, one lease per chat shard (whose cursor is the last
+    # published snapshot that shard has been checked against) and one per running instance.
+    # The holderless 'alert_watermark' row's cursor is the last alert the worker has evaluated.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,              -- 'leader', 'shard:<n>', 'instance:<id>' or 'alert_watermark'
+            holder TEXT,                        -- Instance id, NULL once released
+            expires_at REAL NOT NULL,           -- Unix time
+            cursor INTEGER NOT NULL DEFAULT 0
+        );
+    """)
+    # Schedules the leader scraped, for the other instances to check their shards against
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS published_snapshots (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            published_at REAL NOT NULL,  -- Unix time
+            schedule TEXT NOT NULL,      -- Every slot as JSON (Slot.to_row)
+            opened TEXT NOT NULL,        -- Keys of the slots that opened in this snapshot, as JSON
+            calendar_id TEXT
+        );
+    """)
+    _add_calendar_column(cursor, "published_snapshots")
+    # Every coach seen in a fetched schedule, offered when creating an alert (see coach_directory.py)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS coach_directory (
+            calendar_id TEXT NOT NULL,
+            name TEXT NOT NULL,       -- As written on the calendar
+            first_seen REAL NOT NULL, -- Unix time
+            last_seen REAL NOT NULL,
+            PRIMARY KEY (calendar_id, name)
+        ) WITHOUT ROWID;
+    """)
+
+
+@contextmanager
+def _migration(cursor: sqlite3.Cursor) -> Iterator[None]:
+    """
+    Runs a migration as one explicit transaction, so a failure leaves the old schema intact.
+    sqlite3 only opens transactions before INSERT/UPDATE/DELETE, so DDL would otherwise autocommit.
+    """
+    if cursor.connection.in_transaction:
+        cursor.connection.commit()
+    cursor.execute("BEGIN")
+    try:
+        yield
+    except BaseException:
+        cursor.connection.rollback()
+        raise
+    cursor.connection.commit()
+
+
+def _migrate_alerts(cursor: sqlite3.Cursor):
+    """Adds the normalized columns to an old alerts table and fills them from the text columns."""
+    with _migration(cursor):
+        for column in ("coach_id INTEGER REFERENCES coaches (id)", "day_mask INTEGER",
+                       "start_minute INTEGER", "end_minute INTEGER"):
+            cursor.execute(f"ALTER TABLE alerts ADD COLUMN {column}")
+        cursor.execute("SELECT id, coach_name, days_of_week, time_range FROM alerts")
+        rows = [(*_alert_columns(cursor, coach, days, time_range), alert_id)
+                for alert_id, coach, days, time_range in cursor.fetchall()]
+        cursor.executemany(
+            "UPDATE alerts SET coach_id = ?, day_mask = ?, start_minute = ?, end_minute = ? WHERE id = ?", rows)
+
+
+def _add_calendar_column(cursor: sqlite3.Cursor, table: str):
+    """Adds calendar_id to a table from before calendars could be configured; old rows get the default one."""
+    cursor.execute(f"PRAGMA table_info({table})")
+    if "calendar_id" not in {column[1] for column in cursor.fetchall()}:
+        with _migration(cursor):
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN calendar_id TEXT")
+            cursor.execute(f"UPDATE {table} SET calendar_id = ?", (DEFAULT_CALENDAR_ID,))
+
+
+def _migrate_sent_notifications(cursor: sqlite3.Cursor):
+    """Converts the old free-text key table to hashed keys. Old rows have no slot date and age out by time."""
+    with _migration(cursor):
+        cursor.execute("SELECT chat_id, notification_key, CAST(strftime('%s', timestamp) AS INTEGER) "
+                       "FROM sent_notifications")
+        rows = [(chat_id, notification_key_hash(key), None, sent_at or int(time.time()))
+                for chat_id, key, sent_at in cursor.fetchall()]
+        cursor.execute("ALTER TABLE sent_notifications RENAME TO sent_notifications_old")
+        cursor.execute("""
+            CREATE TABLE sent_notifications (
+                chat_id INTEGER NOT NULL,
+                key_hash INTEGER NOT NULL,
+                slot_date TEXT,
+                sent_at INTEGER NOT NULL,
+                PRIMARY KEY (chat_id, key_hash)
+            ) WITHOUT ROWID;
+        """)
+        cursor.executemany("INSERT OR IGNORE INTO sent_notifications VALUES (?, ?, ?, ?)", rows)
+        cursor.execute("DROP TABLE sent_notifications_old")
+
+def _coach_id(cursor: sqlite3.Cursor, coach: str) -> int:
+    """Returns the id of a coach, adding the coach on first use."""
+    cursor.execute("INSERT OR IGNORE INTO coaches (name, name_key) VALUES (?, ?)", (coach, coach.lower()))
+    cursor.execute("SELECT id FROM coaches WHERE name_key = ?", (coach.lower(),))
+    return cursor.fetchone()[0]
+
+
+def _alert_columns(cursor: sqlite3.Cursor, coach: str, days: str,
+                   time_range: str) -> Tuple[int, int, Optional[int], Optional[int]]:
+    """The (coach_id, day_mask, start_minute, end_minute) stored next to an alert's text columns."""
+    minutes = parse_time_range(time_range) or (None, None)
+    return (_coach_id(cursor, coach), day_mask(days), *minutes)
+
+
+def add_alert(chat_id: int, coach: str, days: str, time_range: str,
+              calendar_id: str = DEFAULT_CALENDAR_ID) -> int:
+    """Adds a new alert to the database and returns its ID."""
+    with _transaction() as cursor:
+        cursor.execute(
+            "INSERT INTO alerts (chat_id, coach_name, days_of_week, time_range, "
+            "coach_id, day_mask, start_minute, end_minute, calendar_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (chat_id, coach, days, time_range, *_alert_columns(cursor, coach, days, time_range), calendar_id)
+        )
+        return cursor.lastrowid
 
 def get_user_alerts(chat_id: int) -> List[Tuple]:
-    """Retrieves all alerts for a specific user."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, coach_name, days_of_week, time_range FROM alerts WHERE chat_id = ?", (chat_id,))
-    alerts = cursor.fetchall()
-    conn.close()
-    return alerts
+    """Retrieves all alerts for a specific user as (id, coach, days, time_range, calendar_id)."""
+    with _transaction() as cursor:
+        cursor.execute("SELECT id, coach_name, days_of_week, time_range, calendar_id FROM alerts WHERE chat_id = ?",
+                       (chat_id,))
+        return cursor.fetchall()
 
 def get_all_alerts() -> List[Tuple]:
     """Retrieves all alerts from the database for the scheduler."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, chat_id, coach_name, days_of_week, time_range FROM alerts")
-    all_alerts = cursor.fetchall()
-    conn.close()
-    return all_alerts
+    with _transaction() as cursor:
+        cursor.execute("SELECT id, chat_id, coach_name, days_of_week, time_range, calendar_id FROM alerts")
+        return cursor.fetchall()
+
+def get_alert(alert_id: int) -> Optional[Tuple]:
+    """Retrieves one alert in the same shape as get_all_alerts(), or None if it does not exist."""
+    with _transaction() as cursor:
+        cursor.execute("SELECT id, chat_id, coach_name, days_of_week, time_range, calendar_id FROM alerts "
+                       "WHERE id = ?", (alert_id,))
+        return cursor.fetchone()
+
+def get_alerts_after(alert_id: int) -> List[Tuple]:
+    """Alerts created after the given id, oldest first, in the same shape as get_all_alerts()."""
+    with _transaction() as cursor:
+        cursor.execute("SELECT id, chat_id, coach_name, days_of_week, time_range, calendar_id FROM alerts "
+                       "WHERE id > ? ORDER BY id", (alert_id,))
+        return cursor.fetchall()
 
 def delete_alert(alert_id: int):
     """Deletes a specific alert by its ID."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM alerts WHERE id = ?", (alert_id,))
-    conn.commit()
-    conn.close()
+    with _transaction() as cursor:
+        cursor.execute("DELETE FROM alerts WHERE id = ?", (alert_id,))
+
+
+def get_matching_alerts(slots: Iterable[Tuple[str, int, int]],
+                        calendar_id: str = DEFAULT_CALENDAR_ID) -> List[Tuple[int, Tuple]]:
+    """
+    Takes (coach, day_mask, start_minute) for each slot of one calendar a run checks and
+    returns (slot_index, alert) for every alert on that calendar that matches, using a
+    single indexed query. As before, an alert matches when its coach name appears in the
+    slot's coach name, it includes the slot's day and its time range contains the slot's start.
+    """
+    rows = [(index, coach.lower(), mask, minute) for index, (coach, mask, minute) in enumerate(slots)]
+    if not rows:
+        return []
+    with _transaction() as cursor:
+        cursor.execute("CREATE TEMP TABLE IF NOT EXISTS candidate_slots "
+                       "(slot_index INTEGER, coach TEXT, day_mask INTEGER, minute INTEGER)")
+        cursor.execute("DELETE FROM candidate_slots")
+        cursor.executemany("INSERT INTO candidate_slots VALUES (?, ?, ?, ?)", rows)
+        # The longest alert bounds how far back the start-minute index range has to reach.
+        max_span = cursor.execute("SELECT MAX(end_minute - start_minute) FROM alerts").fetchone()[0] or 0
+        cursor.execute("""
+            SELECT s.slot_index, a.id, a.chat_id, a.coach_name, a.days_of_week, a.time_range, a.calendar_id
+            FROM candidate_slots s
+            -- CROSS JOIN keeps this order: few slots, then few coaches, then an index search on alerts.
+            CROSS JOIN coaches c ON instr(s.coach, c.name_key) > 0
+            CROSS JOIN alerts a
+                ON a.calendar_id = :calendar_id AND a.coach_id = c.id
+                AND a.start_minute BETWEEN s.minute - :max_span AND s.minute AND a.end_minute >= s.minute
+                AND (a.day_mask & s.day_mask) != 0
+            ORDER BY s.slot_index, a.id
+        """, {"max_span": max_span, "calendar_id": calendar_id})
+        return [(row[0], row[1:]) for row in cursor.fetchall()]
 
 # --- New Functions for Duplicate Prevention ---
 
-def add_sent_notification(chat_id: int, notification_key: str):
+def notification_key_hash(notification_key: str) -> int:
+    """A stable signed 64-bit hash of a notification key, so it fits an SQLite INTEGER."""
+    digest = hashlib.blake2b(notification_key.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+def add_sent_notification(chat_id: int, notification_key: str, slot_date: Optional[date] = None):
     """Records that a notification has been sent to a user."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT OR IGNORE INTO sent_notifications (chat_id, notification_key) VALUES (?, ?)",
-        (chat_id, notification_key)
-    )
-    conn.commit()
-    conn.close()
+    add_sent_notifications([(chat_id, notification_key, slot_date)])
 
 def has_notification_been_sent(chat_id: int, notification_key: str) -> bool:
     """Checks if a specific notification has already been sent to a user."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT 1 FROM sent_notifications WHERE chat_id = ? AND notification_key = ?",
-        (chat_id, notification_key)
-    )
-    result = cursor.fetchone()
-    conn.close()
-    return result is not None
+    with _transaction() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM sent_notifications WHERE chat_id = ? AND key_hash = ?",
+            (chat_id, notification_key_hash(notification_key))
+        )
+        return cursor.fetchone() is not None
+
+# --- Batch Duplicate Prevention ---
+
+def get_unsent_notifications(candidates: Iterable[Tuple[int, str]]) -> Set[Tuple[int, str]]:
+    """
+    Takes every (chat_id, notification_key) pair a run wants to send and returns the
+    ones that have not been sent yet, using a single set-based query.
+    """
+    by_hash = {(chat_id, notification_key_hash(key)): (chat_id, key) for chat_id, key in candidates}
+    if not by_hash:
+        return set()
+    with _transaction() as cursor:
+        cursor.execute("CREATE TEMP TABLE IF NOT EXISTS candidate_notifications (chat_id INTEGER, key_hash INTEGER)")
+        cursor.execute("DELETE FROM candidate_notifications")
+        cursor.executemany("INSERT INTO candidate_notifications (chat_id, key_hash) VALUES (?, ?)", by_hash)
+        cursor.execute("""
+            SELECT c.chat_id, c.key_hash
+            FROM candidate_notifications c
+            LEFT JOIN sent_notifications s
+                ON s.chat_id = c.chat_id AND s.key_hash = c.key_hash
+            WHERE s.chat_id IS NULL
+        """)
+        return {by_hash[row] for row in cursor.fetchall()}
+
+
+def add_sent_notifications(sent: Iterable[Tuple[int, str, Optional[date]]]):
+    """Records a batch of sent (chat_id, notification_key, slot_date) entries in one transaction."""
+    now = int(time.time())
+    rows = [(chat_id, notification_key_hash(key), slot_date.isoformat() if slot_date else None, now)
+            for chat_id, key, slot_date in sent]
+    if not rows:
+        return
+    with _transaction() as cursor:
+        cursor.executemany(
+            "INSERT OR IGNORE INTO sent_notifications (chat_id, key_hash, slot_date, sent_at) VALUES (?, ?, ?, ?)",
+            rows
+        )
+
+# --- Retention ---
+
+def prune_sent_notifications(today: Optional[date] = None) -> int:
+    """
+    Deletes notifications for slots that are already in the past. Rows without a slot
+    date are kept for NOTIFICATION_RETENTION_DAYS. Returns the number of rows deleted.
+    """
+    today = today or date.today()
+    cutoff = int(time.time()) - NOTIFICATION_RETENTION_DAYS * 24 * 60 * 60
+    with _transaction() as cursor:
+        cursor.execute(
+            "DELETE FROM sent_notifications WHERE slot_date < ? OR (slot_date IS NULL AND sent_at < ?)",
+            (today.isoformat(), cutoff)
+        )
+        return cursor.rowcount
+
+
+def get_table_stats() -> Dict[str, object]:
+    """Row counts per table and the size of the database file, for monitoring retention."""
+    with _transaction() as cursor:
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")
+        tables = [row[0] for row in cursor.fetchall()]
+        stats: Dict[str, object] = {}
+        for table in tables:
+            cursor.execute(f'SELECT COUNT(*) FROM "{table}"')
+            stats[f"{table}_rows"] = cursor.fetchone()[0]
+        page_size = cursor.execute("PRAGMA page_size").fetchone()[0]
+        stats["file_bytes"] = cursor.execute("PRAGMA page_count").fetchone()[0] * page_size
+        stats["free_bytes"] = cursor.execute("PRAGMA freelist_count").fetchone()[0] * page_size
+        return stats
+
+
+def compact_database() -> Dict[str, object]:
+    """
+    Prunes expired notifications, then returns free pages to the file system when more
+    than a quarter of the file is unused. Returns table stats from after the compaction.
+    """
+    deleted = prune_sent_notifications()
+    prune_outbox()
+    prune_coach_directory()
+    stats = get_table_stats()
+    with _lock:
+        conn = get_connection()
+        if stats["file_bytes"] and stats["free_bytes"] / stats["file_bytes"] > 0.25:
+            conn.execute("VACUUM")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    stats = get_table_stats()
+    stats["pruned_notifications"] = deleted
+    return stats
+
+# --- Outbox (worker -> bot process) ---
+
+class OutboxMessage(NamedTuple):
+    id: int
+    chat_id: int
+    text: str
+    parse_mode: Optional[str]
+    priority: float
+    attempts: int
+
+
+def enqueue_outbox(messages: Iterable[Tuple[int, str, Optional[str], float]],
+                   sent: Iterable[Tuple[int, str, Optional[date]]]) -> int:
+    """
+    Queues (chat_id, text, parse_mode, priority) messages for the bot process and records
+    the notifications they carry as sent, in one transaction. A crash therefore either
+    loses nothing or queues everything, and the next check will not queue them again.
+    """
+    now = int(time.time())
+    rows = [(chat_id, text, parse_mode, priority, now) for chat_id, text, parse_mode, priority in messages]
+    with _transaction() as cursor:
+        cursor.executemany(
+            "INSERT INTO outbox (chat_id, text, parse_mode, priority, created_at) VALUES (?, ?, ?, ?, ?)", rows)
+        cursor.executemany(
+            "INSERT OR IGNORE INTO sent_notifications (chat_id, key_hash, slot_date, sent_at) VALUES (?, ?, ?, ?)",
+            [(chat_id, notification_key_hash(key), slot_date.isoformat() if slot_date else None, now)
+             for chat_id, key, slot_date in sent]
+        )
+    return len(rows)
+
+
+def claim_outbox(limit: int, lease_seconds: int) -> List[OutboxMessage]:
+    """
+    Takes up to `limit` queued messages, most urgent first, and marks them as claimed.
+    Messages claimed more than `lease_seconds` ago without an outcome are taken again:
+    their bot process died mid-delivery, so they may be delivered twice, never zero times.
+    """
+    now = int(time.time())
+    with _transaction() as cursor:
+        cursor.execute(
+            "SELECT id, chat_id, text, parse_mode, priority, attempts FROM outbox "
+            "WHERE status = 'pending' AND not_before <= ? AND (claimed_at IS NULL OR claimed_at < ?) "
+            "ORDER BY priority, id LIMIT ?",
+            (now, now - lease_seconds, limit)
+        )
+        messages = [OutboxMessage(*row) for row in cursor.fetchall()]
+        cursor.executemany("UPDATE outbox SET claimed_at = ?, attempts = attempts + 1 WHERE id = ?",
+                           [(now, message.id) for message in messages])
+    return [message._replace(attempts=message.attempts + 1) for message in messages]
+
+
+def finish_outbox(delivered: Iterable[int], failed: Iterable[Tuple[int, str]],
+                  retry: Iterable[Tuple[int, str, int]]):
+    """
+    Records the outcome of claimed messages: delivered ids, (id, error) pairs that will not
+    be retried, and (id, error, delay_seconds) pairs that go back in the queue.
+    """
+    now = int(time.time())
+    with _transaction() as cursor:
+        cursor.executemany("UPDATE outbox SET status = 'delivered', finished_at = ?, error = NULL WHERE id = ?",
+                           [(now, message_id) for message_id in delivered])
+        cursor.executemany("UPDATE outbox SET status = 'failed', finished_at = ?, error = ? WHERE id = ?",
+                           [(now, error, message_id) for message_id, error in failed])
+        cursor.executemany("UPDATE outbox SET claimed_at = NULL, not_before = ?, error = ? WHERE id = ?",
+                           [(now + delay, error, message_id) for message_id, error, delay in retry])
+
+
+def get_outbox_stats() -> Dict[str, int]:
+    """Number of outbox rows per status."""
+    with _transaction() as cursor:
+        cursor.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status")
+        return dict(cursor.fetchall())
+
+
+def prune_outbox() -> int:
+    """Deletes delivered and failed outbox rows older than OUTBOX_RETENTION_DAYS."""
+    cutoff = int(time.time()) - OUTBOX_RETENTION_DAYS * 24 * 60 * 60
+    with _transaction() as cursor:
+        cursor.execute("DELETE FROM outbox WHERE status != 'pending' AND finished_at < ?", (cutoff,))
+        return cursor.rowcount
+
+# --- Multi-Instance Coordination ---
+
+class PublishedSnapshot(NamedTuple):
+    id: int
+    published_at: float
+    schedule: List[Slot]
+    opened_slots: List[Slot]
+    calendar_id: str
+
+
+# Takes a lease if it is free, expired or already ours. A shard's cursor survives a change of
+# holder; a shard claimed for the first time starts at the latest published snapshot.
+_TAKE_LEASE = """
+    INSERT INTO leases (name, holder, expires_at, cursor)
+    VALUES (?, ?, ?, (SELECT COALESCE(MAX(id), 0) FROM published_snapshots))
+    ON CONFLICT (name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at
+    WHERE leases.holder = excluded.holder OR leases.holder IS NULL OR leases.expires_at < ?
+"""
+
+
+def acquire_lease(name: str, holder: str, lease_seconds: float) -> bool:
+    """Takes or renews the named lease for `lease_seconds`. Returns False if another holder has it."""
+    now = time.time()
+    with _transaction() as cursor:
+        cursor.execute(_TAKE_LEASE, (name, holder, now + lease_seconds, now))
+        return cursor.rowcount > 0
+
+
+def claim_shards(holder: str, shards: int, lease_seconds: float, rebalance: bool = True) -> List[int]:
+    """
+    Renews this instance's lease and its shard leases, and moves towards an even split:
+    shards beyond the fair share (shards / live instances, rounded up) are released
+    and free or expired shards are taken up to it. With `rebalance=False` nothing held
+    is released, e.g. while those shards are still being worked on. Returns the shards held.
+    """
+    now = time.time()
+    with _transaction() as cursor:
+        cursor.execute(_TAKE_LEASE, (f"instance:{holder}", holder, now + lease_seconds, now))
+        cursor.execute("SELECT COUNT(*) FROM leases WHERE name LIKE 'instance:%' AND expires_at >= ?", (now,))
+        fair_share = -(-shards // cursor.fetchone()[0])
+        cursor.execute("SELECT name FROM leases WHERE name LIKE 'shard:%' AND holder = ?", (holder,))
+        held = sorted(int(name.split(":")[1]) for name, in cursor.fetchall())
+        held = [shard for shard in held if shard < shards]
+        if rebalance and len(held) > fair_share:
+            cursor.executemany("UPDATE leases SET holder = NULL, expires_at = 0 WHERE name = ? AND holder = ?",
+                               [(f"shard:{shard}", holder) for shard in held[fair_share:]])
+            held = held[:fair_share]
+        owned = []
+        for shard in held + [shard for shard in range(shards) if shard not in held]:
+            if len(owned) >= max(fair_share, len(held)):
+                break
+            cursor.execute(_TAKE_LEASE, (f"shard:{shard}", holder, now + lease_seconds, now))
+            if cursor.rowcount > 0:
+                owned.append(shard)
+        # Instances that stopped without releasing their lease a day ago are forgotten.
+        cursor.execute("DELETE FROM leases WHERE name LIKE 'instance:%' AND expires_at < ?", (now - 24 * 60 * 60,))
+    return sorted(owned)
+
+
+def release_leases(holder: str):
+    """Gives up every lease of an instance that is shutting down, so others take over at once."""
+    with _transaction() as cursor:
+        cursor.execute("UPDATE leases SET holder = NULL, expires_at = 0 WHERE holder = ?", (holder,))
+
+
+def get_shard_cursors(holder: str, shards: Iterable[int]) -> Dict[int, int]:
+    """The cursor of each of the given shards that `holder` still holds."""
+    shards = list(shards)
+    with _transaction() as cursor:
+        cursor.execute(f"SELECT name, cursor FROM leases WHERE holder = ? AND name IN "
+                       f"({','.join('?' * len(shards))})", [holder] + [f"shard:{shard}" for shard in shards])
+        return {int(name.split(":")[1]): position for name, position in cursor.fetchall()}
+
+
+def advance_shard_cursors(holder: str, shards: Iterable[int], snapshot_id: int) -> int:
+    """Records that the shards were checked against a snapshot. Shards no longer held are skipped."""
+    with _transaction() as cursor:
+        cursor.executemany("UPDATE leases SET cursor = ? WHERE name = ? AND holder = ? AND cursor < ?",
+                           [(snapshot_id, f"shard:{shard}", holder, snapshot_id) for shard in shards])
+        return cursor.rowcount
+
+
+def get_alert_watermark() -> int:
+    """
+    The id of the last alert the worker has evaluated. The first call starts it at the
+    newest alert (0 if there are none), so only alerts created from then on are new.
+    """
+    with _transaction() as cursor:
+        cursor.execute("INSERT OR IGNORE INTO leases (name, holder, expires_at, cursor) "
+                       "SELECT 'alert_watermark', NULL, 0, COALESCE(MAX(id), 0) FROM alerts")
+        cursor.execute("SELECT cursor FROM leases WHERE name = 'alert_watermark'")
+        return cursor.fetchone()[0]
+
+
+def advance_alert_watermark(alert_id: int):
+    """Records that every alert up to `alert_id` has been evaluated."""
+    with _transaction() as cursor:
+        cursor.execute("UPDATE leases SET cursor = ? WHERE name = 'alert_watermark' AND cursor < ?",
+                       (alert_id, alert_id))
+
+
+def get_leases() -> List[Tuple[str, Optional[str], float, int]]:
+    """Every lease as (name, holder, expires_at, cursor), for /stats."""
+    with _transaction() as cursor:
+        cursor.execute("SELECT name, holder, expires_at, cursor FROM leases ORDER BY name")
+        return cursor.fetchall()
+
+
+def publish_snapshot(schedule: List[Slot], opened_slots: List[Slot], keep: int,
+                     calendar_id: str = DEFAULT_CALENDAR_ID) -> int:
+    """Stores a calendar's schedule for the other instances and keeps only its newest `keep`. Returns its id."""
+    with _transaction() as cursor:
+        cursor.execute(
+            "INSERT INTO published_snapshots (published_at, schedule, opened, calendar_id) VALUES (?, ?, ?, ?)",
+            (time.time(), json.dumps([slot.to_row() for slot in schedule]),
+             json.dumps([slot.key for slot in opened_slots]), calendar_id)
+        )
+        snapshot_id = cursor.lastrowid
+        cursor.execute("DELETE FROM published_snapshots WHERE calendar_id = ? AND id NOT IN "
+                       "(SELECT id FROM published_snapshots WHERE calendar_id = ? ORDER BY id DESC LIMIT ?)",
+                       (calendar_id, calendar_id, keep))
+        return snapshot_id
+
+
+def _load_published(row: Tuple) -> PublishedSnapshot:
+    snapshot_id, published_at, schedule, opened, calendar_id = row
+    slots = [Slot.from_row(slot) for slot in json.loads(schedule)]
+    opened = set(json.loads(opened))
+    return PublishedSnapshot(snapshot_id, published_at, slots, [slot for slot in slots if slot.key in opened],
+                             calendar_id)
+
+
+def get_published_snapshots(after_id: int) -> List[PublishedSnapshot]:
+    """Every stored snapshot newer than `after_id`, of any calendar, oldest first."""
+    with _transaction() as cursor:
+        cursor.execute("SELECT id, published_at, schedule, opened, calendar_id FROM published_snapshots "
+                       "WHERE id > ? ORDER BY id", (after_id,))
+        return [_load_published(row) for row in cursor.fetchall()]
+
+
+def get_latest_published_snapshot(calendar_id: str = DEFAULT_CALENDAR_ID) -> Optional[PublishedSnapshot]:
+    with _transaction() as cursor:
+        cursor.execute("SELECT id, published_at, schedule, opened, calendar_id FROM published_snapshots "
+                       "WHERE calendar_id = ? ORDER BY id DESC LIMIT 1", (calendar_id,))
+        row = cursor.fetchone()
+        return _load_published(row) if row else None
+
+# --- Change Detection State ---
+
+class PageState(NamedTuple):
+    content_hash: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+    slots: List[Slot]
+
+
+def get_page_states(urls: Optional[Iterable[str]] = None) -> Dict[str, PageState]:
+    """Returns the stored state of the given calendar pages (all of them if None) we have fetched, keyed by URL."""
+    with _transaction() as cursor:
+        if urls is None:
+            cursor.execute("SELECT url, content_hash, etag, last_modified, slots FROM page_state")
+        else:
+            urls = list(urls)
+            cursor.execute(f"SELECT url, content_hash, etag, last_modified, slots FROM page_state "
+                           f"WHERE url IN ({','.join('?' * len(urls))})", urls)
+        return {
+            url: PageState(content_hash, etag, last_modified, [Slot.from_row(row) for row in json.loads(slots)])
+            for url, content_hash, etag, last_modified, slots in cursor.fetchall()
+        }
+
+
+def save_page_state(url: str, content_hash: str, etag: Optional[str], last_modified: Optional[str],
+                    slots: List[Slot]):
+    """Stores the hash, HTTP validators and parsed slots of a calendar page.
+    Pages that have not changed for two weeks (mostly past weeks) are dropped; at worst they get parsed again."""
+    with _transaction() as cursor:
+        cursor.execute(
+            "INSERT OR REPLACE INTO page_state (url, content_hash, etag, last_modified, slots, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)",
+            (url, content_hash, etag, last_modified, json.dumps([slot.to_row() for slot in slots]))
+        )
+        cursor.execute("DELETE FROM page_state WHERE updated_at < datetime('now', '-14 days')")
+
+
+def get_slot_snapshot(calendar_id: str = DEFAULT_CALENDAR_ID) -> Dict[str, bool]:
+    """Returns the availability of every slot of a calendar as of the last check, keyed by slot key."""
+    with _transaction() as cursor:
+        cursor.execute("SELECT slot_key, available FROM slot_snapshot WHERE calendar_id = ?", (calendar_id,))
+        return {slot_key: bool(available) for slot_key, available in cursor.fetchall()}
+
+
+def replace_slot_snapshot(snapshot: Dict[str, bool], calendar_id: str = DEFAULT_CALENDAR_ID):
+    """Replaces a calendar's stored slot snapshot with a new one in a single transaction."""
+    with _transaction() as cursor:
+        cursor.execute("DELETE FROM slot_snapshot WHERE calendar_id = ?", (calendar_id,))
+        cursor.executemany(
+            "INSERT OR REPLACE INTO slot_snapshot (slot_key, available, calendar_id) VALUES (?, ?, ?)",
+            ((slot_key, int(available), calendar_id) for slot_key, available in snapshot.items())
+        )
+
+# --- Coach Directory ---
+
+class CoachSighting(NamedTuple):
+    calendar_id: str
+    name: str
+    first_seen: float  # Unix time
+    last_seen: float
+
+
+def record_coaches(calendar_id: str, names: Iterable[str], seen_at: float):
+    """Adds coaches seen on a calendar, or moves their last_seen forward if they are already known."""
+    with _transaction() as cursor:
+        cursor.executemany(
+            "INSERT INTO coach_directory (calendar_id, name, first_seen, last_seen) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (calendar_id, name) DO UPDATE SET last_seen = MAX(last_seen, excluded.last_seen)",
+            ((calendar_id, name, seen_at, seen_at) for name in names)
+        )
+
+
+def get_coach_directory() -> List[CoachSighting]:
+    """Every coach in the directory, of every calendar."""
+    with _transaction() as cursor:
+        cursor.execute("SELECT calendar_id, name, first_seen, last_seen FROM coach_directory")
+        return [CoachSighting(*row) for row in cursor.fetchall()]
+
+
+def prune_coach_directory() -> int:
+    """Deletes coaches not seen on their calendar for COACH_DIRECTORY_STALE_DAYS."""
+    cutoff = time.time() - COACH_DIRECTORY_STALE_DAYS * 24 * 60 * 60
+    with _transaction() as cursor:
+        cursor.execute("DELETE FROM coach_directory WHERE last_seen < ?", (cutoff,))
+        return cursor.rowcount
 
 # Initialize the database when the module is first imported
 initialize_database()
\ No newline at end of file
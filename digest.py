@@ -0,0 +1,83 @@
+# digest.py
+
+from typing import Callable, Dict, List, Sequence, Tuple
+
+from telegram.helpers import escape_markdown
+
+from calendars import all_calendars, get_calendar
+from config import MAX_MESSAGE_LENGTH
+from dispatcher import Notification
+from matcher import Alert
+from slot import Slot
+
+# One new match for a chat: (notification_key, slot, the alert that matched it)
+Match = Tuple[str, Slot, Alert]
+
+
+def club_name(slot: Slot) -> str:
+    """The club a slot belongs to, escaped for Markdown. Empty when only one calendar is configured."""
+    return escape_markdown(get_calendar(slot.calendar).name) if len(all_calendars()) > 1 else ""
+
+
+def format_single(slot: Slot, alert: Alert) -> str:
+    """The message for a chat with exactly one new slot."""
+    alert_id, chat_id, coach, days, time_range, calendar_id = alert
+    club = club_name(slot)
+    # Nothing can be escaped inside a code span, so a backtick in the name is replaced instead.
+    coach = coach.replace("`", "'")
+    return (
+        f"🔔 **Class Available!**\n\n"
+        + (f"**Club:** {club}\n" if club else "")
+        + f"**Coach:** {escape_markdown(slot.coach)}\n"
+        f"**Day:** {slot.day}, {slot.date}\n"
+        f"**Time:** {slot.time}\n\n"
+        f"This matches your alert for `{coach}` on `{days}` between `{time_range}`."
+    )
+
+
+def build_digests(chat_id: int, matches: Sequence[Match], priority: Callable[[Slot], float],
+                  max_length: int = MAX_MESSAGE_LENGTH) -> List[Notification]:
+    """
+    Turns every new match for one chat into as few messages as possible.
+
+    A single match keeps the detailed one-slot message. Several matches become a digest
+    grouped by club, coach and day, split on line boundaries so each message stays under
+    Telegram's length limit. Each notification's payload lists the matches it covers.
+    """
+    if len(matches) == 1:
+        key, slot, alert = matches[0]
+        return [Notification(chat_id, format_single(slot, alert), priority=priority(slot), payload=list(matches))]
+
+    # Group by coach and day; the group with the soonest slot comes first.
+    groups: Dict[Tuple[str, str, str, str], List[Match]] = {}
+    for match in sorted(matches, key=lambda m: priority(m[1])):
+        slot = match[1]
+        groups.setdefault((club_name(slot), slot.coach, slot.day, slot.date), []).append(match)
+
+    notifications = []
+    lines: List[str] = [f"🔔 **{len(matches)} Classes Available!**"]
+    length = len(lines[0])
+    covered: List[Match] = []
+
+    def flush():
+        notifications.append(Notification(chat_id, "\n".join(lines), payload=covered,
+                                          priority=min(priority(match[1]) for match in covered)))
+
+    for (club, coach, day, date), group in groups.items():
+        heading = f"\n**{escape_markdown(coach)}** · {day}, {date}" + (f" · {club}" if club else "")
+        pending = [heading]
+        for match in group:
+            line = f"  • {match[1].time}"
+            if covered and length + sum(len(text) + 1 for text in pending) + len(line) + 1 > max_length:
+                # Start a new message, repeating the coach/day heading if we split inside it.
+                flush()
+                lines, covered = ["🔔 **More Classes Available:**"], []
+                length = len(lines[0])
+                pending = [heading]
+            for text in pending + [line]:
+                lines.append(text)
+                length += len(text) + 1
+            pending = []
+            covered.append(match)
+    flush()
+    return notifications
@@ -0,0 +1,200 @@
+# dispatcher.py
+
+import asyncio
+import itertools
+import logging
+import time
+from typing import Dict, List, Optional, Sequence
+
+from telegram import Bot
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+
+from config import (
+    DISPATCH_CONCURRENCY, DISPATCH_MAX_RETRIES, TELEGRAM_GLOBAL_RATE, TELEGRAM_PER_CHAT_RATE,
+)
+from metrics import metrics
+
+# Get the logger
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Allows `rate` operations per second on average, with bursts of up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + max(0.0, now - self._updated) * self.rate)
+        self._updated = max(self._updated, now)
+
+    async def acquire(self):
+        """Waits until a token is available and takes it."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._blocked_until:
+                    await asyncio.sleep(self._blocked_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    @property
+    def blocked(self) -> bool:
+        return time.monotonic() < self._blocked_until
+
+    def block_for(self, seconds: float):
+        """Stops handing out tokens for `seconds` (used when Telegram asks us to back off)."""
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+        self._tokens = 0
+        self._updated = self._blocked_until
+
+    @property
+    def idle(self) -> bool:
+        """True if the bucket is full again, i.e. it can be dropped without losing any state."""
+        self._refill(time.monotonic())
+        return self._tokens >= self.capacity and not self._lock.locked()
+
+
+class Notification:
+    """
+    One message to deliver. Lower `priority` is sent first; the scheduler uses the
+    slot's start time so the soonest openings go out before slots weeks away.
+    """
+
+    __slots__ = ('chat_id', 'text', 'parse_mode', 'priority', 'payload', 'attempts', 'sent', 'error')
+
+    def __init__(self, chat_id: int, text: str, priority: float = 0, parse_mode: Optional[str] = 'Markdown',
+                 payload: object = None):
+        self.chat_id = chat_id
+        self.text = text
+        self.parse_mode = parse_mode
+        self.priority = priority
+        self.payload = payload  # Whatever the caller needs back, e.g. the dedup keys
+        self.attempts = 0
+        self.sent = False
+        self.error: Optional[Exception] = None
+
+
+class NotificationDispatcher:
+    """
+    Delivers notifications through a priority queue drained by a fixed number of workers.
+
+    Every send takes a token from a global bucket and from the recipient's own bucket,
+    matching Telegram's limits (about 30 messages per second overall and one per second
+    per chat). RetryAfter pauses the global bucket for the requested time and puts the
+    message back in the queue; network errors are retried with a backoff.
+    """
+
+    def __init__(self, bot: Bot, concurrency: int = DISPATCH_CONCURRENCY,
+                 global_rate: float = TELEGRAM_GLOBAL_RATE, per_chat_rate: float = TELEGRAM_PER_CHAT_RATE,
+                 max_retries: int = DISPATCH_MAX_RETRIES):
+        self.bot = bot
+        self.concurrency = concurrency
+        self.per_chat_rate = per_chat_rate
+        self.max_retries = max_retries
+        self._global_bucket = TokenBucket(global_rate, capacity=global_rate)
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._workers: List[asyncio.Task] = []
+        # Tie-breaker so equal priorities keep their submission order.
+        self._sequence = itertools.count()
+
+    def _ensure_workers(self):
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+        self._workers = [worker for worker in self._workers if not worker.done()]
+        while len(self._workers) < self.concurrency:
+            self._workers.append(asyncio.create_task(self._worker()))
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 10000:
+                self._chat_buckets = {cid: b for cid, b in self._chat_buckets.items() if not b.idle}
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.per_chat_rate)
+        return bucket
+
+    async def dispatch(self, notifications: Sequence[Notification]) -> List[Notification]:
+        """
+        Queues the notifications and waits until each one is either sent or has failed.
+        Returns them with `sent` / `error` filled in.
+        """
+        if not notifications:
+            return []
+        self._ensure_workers()
+        loop = asyncio.get_running_loop()
+        futures = []
+        for notification in notifications:
+            done = loop.create_future()
+            futures.append(done)
+            self._queue.put_nowait((notification.priority, next(self._sequence), notification, done))
+        await asyncio.gather(*futures)
+        return list(notifications)
+
+    async def _worker(self):
+        while True:
+            priority, sequence, notification, done = await self._queue.get()
+            try:
+                retry_in = await self._send(notification)
+                if retry_in is None:
+                    done.set_result(notification)
+                else:
+                    # Requeue after the delay without holding up this worker.
+                    asyncio.get_running_loop().call_later(
+                        retry_in, self._queue.put_nowait, (priority, sequence, notification, done))
+            except Exception as e:  # Never let a worker die
+                notification.error = e
+                done.set_result(notification)
+            finally:
+                self._queue.task_done()
+
+    async def _send(self, notification: Notification) -> Optional[float]:
+        """Sends once. Returns None when finished (sent or given up), or the delay before a retry."""
+        await self._chat_bucket(notification.chat_id).acquire()
+        await self._global_bucket.acquire()
+        notification.attempts += 1
+        started = time.perf_counter()
+        try:
+            await self.bot.send_message(chat_id=notification.chat_id, text=notification.text,
+                                        parse_mode=notification.parse_mode)
+            metrics.observe("telegram_send_seconds", time.perf_counter() - started)
+            notification.sent = True
+            notification.error = None
+            return None
+        except RetryAfter as e:
+            metrics.inc("telegram_retry_after_total")
+            if not self._global_bucket.blocked:
+                logger.warning(f"Telegram flood control: pausing sends for {e.retry_after}s.")
+            self._global_bucket.block_for(e.retry_after)
+            notification.error = e
+            # Flood waits do not count against the retry budget.
+            notification.attempts -= 1
+            return e.retry_after
+        except (Forbidden, BadRequest) as e:
+            # The user blocked the bot or the message is invalid; retrying will not help.
+            metrics.inc("telegram_send_failures_total", error=type(e).__name__)
+            notification.error = e
+            return None
+        except TelegramError as e:
+            metrics.inc("telegram_send_failures_total", error=type(e).__name__)
+            notification.error = e
+            if notification.attempts > self.max_retries:
+                return None
+            return 2 ** notification.attempts
+
+    async def close(self):
+        """Stops the workers. Queued notifications that were not sent are left unresolved."""
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._queue = None
@@ -0,0 +1,58 @@
+# fake_bot.py
+
+import asyncio
+import time
+from collections import defaultdict, deque
+from typing import Deque, Dict, List, NamedTuple, Optional
+
+from telegram.error import RetryAfter
+
+
+class SentMessage(NamedTuple):
+    chat_id: int
+    text: str
+    parse_mode: Optional[str]
+    sent_at: float
+
+
+class FakeBot:
+    """
+    A stand-in for telegram.Bot for local testing and benchmarks. It records every
+    message instead of sending it and can enforce Telegram-like flood limits,
+    answering with RetryAfter the same way the real API does.
+    """
+
+    def __init__(self, latency: float = 0.0, global_limit: Optional[int] = None,
+                 per_chat_limit: Optional[int] = None, retry_after: int = 1):
+        self.latency = latency
+        self.global_limit = global_limit  # Messages per second across all chats
+        self.per_chat_limit = per_chat_limit  # Messages per second to one chat
+        self.retry_after = retry_after
+        self.sent: List[SentMessage] = []
+        self.flood_errors = 0
+        self._recent: Deque[float] = deque()
+        self._recent_by_chat: Dict[int, Deque[float]] = defaultdict(deque)
+
+    @staticmethod
+    def _over_limit(window: Deque[float], limit: Optional[int], now: float) -> bool:
+        while window and now - window[0] >= 1:
+            window.popleft()
+        return limit is not None and len(window) >= limit
+
+    async def send_message(self, chat_id: int, text: str, parse_mode: Optional[str] = None, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        now = time.monotonic()
+        chat_window = self._recent_by_chat[chat_id]
+        if self._over_limit(self._recent, self.global_limit, now) or \
+                self._over_limit(chat_window, self.per_chat_limit, now):
+            self.flood_errors += 1
+            raise RetryAfter(self.retry_after)
+        self._recent.append(now)
+        chat_window.append(now)
+        message = SentMessage(chat_id, text, parse_mode, now)
+        self.sent.append(message)
+        return message
+
+    def messages_for(self, chat_id: int) -> List[SentMessage]:
+        return [message for message in self.sent if message.chat_id == chat_id]
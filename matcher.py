@@ -0,0 +1,161 @@
+# matcher.py
+
+import re
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Sequence, Tuple
+
+if TYPE_CHECKING:
+    from slot import Slot  # slot.py imports this module
+
+# Alert rows as returned by database.get_all_alerts() and get_matching_alerts():
+# (id, chat_id, coach_name, days_of_week, time_range, calendar_id)
+Alert = Tuple[int, int, str, str, str, str]
+
+DAY_NAMES = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+DAY_BITS = {day: 1 << index for index, day in enumerate(DAY_NAMES)}
+
+_HHMM = re.compile(r'(\d{1,2}):(\d{1,2})')
+
+
+def parse_minutes(text: str) -> Optional[int]:
+    """Converts 'HH:MM' to minutes since midnight, or None if it is not a valid time."""
+    match = _HHMM.fullmatch(text)
+    if not match:
+        return None
+    hours, minutes = int(match.group(1)), int(match.group(2))
+    if hours > 23 or minutes > 59:
+        return None
+    return hours * 60 + minutes
+
+
+def parse_time_range(time_range: str) -> Optional[Tuple[int, int]]:
+    """Converts 'HH:MM-HH:MM' to a (start, end) pair of minutes, or None if it is malformed."""
+    parts = time_range.split('-')
+    if len(parts) != 2:
+        return None
+    start, end = parse_minutes(parts[0]), parse_minutes(parts[1])
+    if start is None or end is None:
+        return None
+    return start, end
+
+
+def day_mask(days: str) -> int:
+    """Converts a comma-joined list of day names to a bitmask."""
+    mask = 0
+    for day in days.split(','):
+        mask |= DAY_BITS.get(day.strip(), 0)
+    return mask
+
+
+def slot_day_mask(day: str) -> int:
+    """
+    The day bit of a slot. A label that is not a full weekday name keeps the original
+    substring rule: it matches every weekday whose name contains it.
+    """
+    bit = DAY_BITS.get(day)
+    if bit is not None:
+        return bit
+    return sum(bit for name, bit in DAY_BITS.items() if day in name)
+
+
+class IntervalTree:
+    """
+    A static centered interval tree. stab(point) returns every item whose
+    [start, end] range contains the point in O(log n + matches).
+    """
+
+    __slots__ = ('center', 'by_start', 'by_end', 'left', 'right')
+
+    def __init__(self, intervals: Sequence[Tuple[int, int, object]]):
+        endpoints = sorted(point for start, end, _ in intervals for point in (start, end))
+        self.center = endpoints[len(endpoints) // 2]
+        left = [iv for iv in intervals if iv[1] < self.center]
+        right = [iv for iv in intervals if iv[0] > self.center]
+        overlapping = [iv for iv in intervals if iv[0] <= self.center <= iv[1]]
+        self.by_start = sorted(overlapping, key=lambda iv: iv[0])
+        self.by_end = sorted(overlapping, key=lambda iv: iv[1], reverse=True)
+        self.left = IntervalTree(left) if left else None
+        self.right = IntervalTree(right) if right else None
+
+    def stab(self, point: int) -> List[object]:
+        found = []
+        node = self
+        while node is not None:
+            if point < node.center:
+                for start, _, item in node.by_start:
+                    if start > point:
+                        break
+                    found.append(item)
+                node = node.left
+            elif point > node.center:
+                for _, end, item in node.by_end:
+                    if end < point:
+                        break
+                    found.append(item)
+                node = node.right
+            else:
+                found.extend(item for _, _, item in node.by_start)
+                break
+        return found
+
+
+class AlertMatcher:
+    """
+    Matches slots against alerts without looping over every alert.
+
+    Alerts are parsed once into minute ranges and day bitmasks, bucketed by coach and
+    weekday, and stored in an interval tree per bucket. Coach names keep the original
+    rule that the alert's coach must appear inside the slot's coach name.
+    """
+
+    def __init__(self, alerts: Sequence[Alert]):
+        buckets: Dict[Tuple[str, int], List[Tuple[int, int, Alert]]] = {}
+        self._by_coach: Dict[str, List[Tuple[int, int, Alert]]] = {}
+        for alert in alerts:
+            coach, days, time_range = alert[2:5]
+            minutes = parse_time_range(time_range)
+            if minutes is None or minutes[0] > minutes[1]:
+                continue  # Such an alert can never match
+            start, end = minutes
+            coach_key = coach.lower()
+            self._by_coach.setdefault(coach_key, []).append((start, end, alert))
+            mask = day_mask(days)
+            for index in range(len(DAY_NAMES)):
+                if mask & (1 << index):
+                    buckets.setdefault((coach_key, index), []).append((start, end, alert))
+
+        self._trees = {key: IntervalTree(intervals) for key, intervals in buckets.items()}
+        self._coach_keys: Dict[str, List[str]] = {}
+
+    def _matching_coaches(self, slot_coach: str) -> List[str]:
+        """Alert coach names contained in this slot's coach name. Cached: there are only a few coaches."""
+        keys = self._coach_keys.get(slot_coach)
+        if keys is None:
+            lowered = slot_coach.lower()
+            keys = [coach_key for coach_key in self._by_coach if coach_key in lowered]
+            self._coach_keys[slot_coach] = keys
+        return keys
+
+    def match(self, slot: "Slot") -> List[Alert]:
+        """Returns every alert that matches this slot."""
+        minute = slot.start_minute
+        if minute is None:
+            return []
+
+        matches = []
+        day_bit = DAY_BITS.get(slot.day)
+        for coach_key in self._matching_coaches(slot.coach):
+            if day_bit is not None:
+                tree = self._trees.get((coach_key, day_bit.bit_length() - 1))
+                if tree is not None:
+                    matches.extend(tree.stab(minute))
+            else:
+                # Not a full day name: fall back to the original substring test.
+                matches.extend(alert for start, end, alert in self._by_coach[coach_key]
+                               if slot.day in alert[3] and start <= minute <= end)
+        return matches
+
+    def match_all(self, slots: Sequence["Slot"]) -> Iterator[Tuple[Alert, "Slot"]]:
+        """Yields (alert, slot) for every matching pair."""
+        for slot in slots:
+            for alert in self.match(slot):
+                yield alert, slot
@@ -0,0 +1,210 @@
+# metrics.py
+
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# Get the logger
+logger = logging.getLogger(__name__)
+
+# Upper bounds (seconds) of the latency histogram buckets: 1 ms up to 1 minute.
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+# A metric is identified by its name plus a sorted tuple of (label, value) pairs.
+MetricKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+def _key(name: str, labels: Dict[str, object]) -> MetricKey:
+    return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+
+class Histogram:
+    """Counts observations per bucket; quantiles are estimated from the bucket bounds."""
+
+    __slots__ = ('buckets', 'counts', 'count', 'total', 'max')
+
+    def __init__(self, buckets: List[float] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last one is +Inf
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> float:
+        """The upper bound of the bucket holding the q-th observation (the max for the +Inf bucket)."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(self.buckets[index], self.max) if index < len(self.buckets) else self.max
+        return self.max
+
+
+class MetricsRegistry:
+    """
+    Process-wide counters and latency histograms.
+
+    Recording is a dict lookup and an addition under an uncontended lock, so it is
+    cheap enough to leave on in production. Updates come from the event loop, the
+    database thread and the metrics server thread, hence the lock.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[MetricKey, float] = {}
+        self._histograms: Dict[MetricKey, Histogram] = {}
+        self.started_at = time.time()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def span(self, name: str, **labels) -> Iterator[None]:
+        """
+        Times the enclosed block into the `<name>_seconds` histogram. A block that raises
+        also counts towards `<name>_failures_total`. Works inside coroutines as a plain `with`.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.inc(f"{name}_failures_total", **labels)
+            raise
+        finally:
+            self.observe(f"{name}_seconds", time.perf_counter() - start, **labels)
+
+    def counter(self, name: str, **labels) -> float:
+        with self._lock:
+            return self._counters.get(_key(name, labels), 0)
+
+    def histogram(self, name: str, **labels) -> Optional[Histogram]:
+        with self._lock:
+            return self._histograms.get(_key(name, labels))
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+            self.started_at = time.time()
+
+    # --- Output ---
+
+    def render_prometheus(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        def fmt(labels: Tuple[Tuple[str, str], ...], extra: str = "") -> str:
+            parts = [f'{label}="{value}"' for label, value in labels]
+            if extra:
+                parts.append(extra)
+            return "{" + ",".join(parts) + "}" if parts else ""
+
+        lines = []
+        with self._lock:
+            for name in sorted({name for name, _ in self._counters}):
+                lines.append(f"# TYPE fencing_{name} counter")
+                for (metric, labels), value in sorted(self._counters.items()):
+                    if metric == name:
+                        lines.append(f"fencing_{name}{fmt(labels)} {value:g}")
+            for name in sorted({name for name, _ in self._histograms}):
+                lines.append(f"# TYPE fencing_{name} histogram")
+                for (metric, labels), histogram in sorted(self._histograms.items(), key=lambda item: item[0]):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + [float('inf')], histogram.counts):
+                        cumulative += count
+                        le = "+Inf" if bound == float('inf') else f"{bound:g}"
+                        bucket_labels = fmt(labels, 'le="' + le + '"')
+                        lines.append(f"fencing_{name}_bucket{bucket_labels} {cumulative}")
+                    lines.append(f"fencing_{name}_sum{fmt(labels)} {histogram.total:.6f}")
+                    lines.append(f"fencing_{name}_count{fmt(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> List[str]:
+        """Short human-readable lines: every counter, then count / p50 / p95 / max per histogram."""
+        def label_text(labels: Tuple[Tuple[str, str], ...]) -> str:
+            return "[" + ",".join(f"{label}={value}" for label, value in labels) + "]" if labels else ""
+
+        lines = []
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.items()):
+                lines.append(f"{name}{label_text(labels)}: {value:g}")
+            for (name, labels), histogram in sorted(self._histograms.items(), key=lambda item: item[0]):
+                lines.append(f"{name}{label_text(labels)}: n={histogram.count} "
+                             f"p50={histogram.quantile(0.5) * 1000:.0f}ms "
+                             f"p95={histogram.quantile(0.95) * 1000:.0f}ms "
+                             f"max={histogram.max * 1000:.0f}ms")
+        return lines
+
+
+# The process-wide registry every module records into.
+metrics = MetricsRegistry()
+
+# --- Local Metrics Endpoint ---
+
+_server: Optional[ThreadingHTTPServer] = None
+
+
+def start_metrics_server(host: str, port: int) -> Optional[ThreadingHTTPServer]:
+    """
+    Serves GET /metrics in the Prometheus text format on a background thread.
+    Does nothing if `port` is 0. Bind it to localhost; there is no authentication.
+    """
+    global _server
+    if not port or _server is not None:
+        return _server
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render_prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    try:
+        _server = ThreadingHTTPServer((host, port), Handler)
+    except OSError as e:
+        logger.error(f"Could not start the metrics endpoint on {host}:{port}: {e}")
+        return None
+    threading.Thread(target=_server.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"Metrics available at http://{host}:{port}/metrics")
+    return _server
+
+
+def stop_metrics_server():
+    global _server
+    if _server is not None:
+        _server.shutdown()
+        _server.server_close()
+    _server = None
@@ -0,0 +1,208 @@
+# page_archive.py
+#
+# Every calendar page we download is kept on disk so parser bugs and slow pages can be
+# reproduced later. Pages are gzip-compressed and stored once per distinct content
+# (named by their SHA-256); index.jsonl records which URL returned which page and when.
+#
+#   python page_archive.py stats                 # size and number of pages
+#   python page_archive.py reparse [--engine X]  # parse every archived page, compare with bs4
+#   python page_archive.py prune                 # apply the retention limits now
+
+import argparse
+import gzip
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Iterator, List, NamedTuple, Optional
+
+from config import PAGE_ARCHIVE_DIR, PAGE_ARCHIVE_RETENTION_DAYS, PAGE_ARCHIVE_MAX_MB
+
+# Get the logger
+logger = logging.getLogger(__name__)
+
+INDEX_FILE = "index.jsonl"
+_lock = threading.Lock()
+
+
+class ArchiveEntry(NamedTuple):
+    fetched_at: float  # Unix time
+    url: str
+    content_hash: str  # SHA-256 hex digest of the page
+
+
+def _object_path(content_hash: str, root: str) -> str:
+    return os.path.join(root, "objects", content_hash[:2], f"{content_hash}.html.gz")
+
+
+def _write_atomic(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp = f"{path}.tmp"
+    with open(temp, "wb") as f:
+        f.write(data)
+    os.replace(temp, path)
+
+
+def store(url: str, content: bytes, content_hash: str, fetched_at: Optional[float] = None,
+          root: str = PAGE_ARCHIVE_DIR) -> bool:
+    """
+    Archives one fetched page. The compressed copy is only written if no identical page
+    is stored yet. Returns True if a new copy was written. Blocking; call it off the event loop.
+    """
+    if not root:
+        return False
+    path = _object_path(content_hash, root)
+    with _lock:
+        written = False
+        if not os.path.exists(path):
+            _write_atomic(path, gzip.compress(content, compresslevel=6))
+            written = True
+        with open(os.path.join(root, INDEX_FILE), "a") as f:
+            f.write(json.dumps({"t": fetched_at or time.time(), "url": url, "sha256": content_hash}) + "\n")
+    return written
+
+
+def load(content_hash: str, root: str = PAGE_ARCHIVE_DIR) -> bytes:
+    """Returns the archived page with this hash. Raises FileNotFoundError if it is not stored."""
+    with open(_object_path(content_hash, root), "rb") as f:
+        return gzip.decompress(f.read())
+
+
+def entries(root: str = PAGE_ARCHIVE_DIR) -> List[ArchiveEntry]:
+    """Every recorded fetch, oldest first."""
+    path = os.path.join(root, INDEX_FILE)
+    if not root or not os.path.exists(path):
+        return []
+    result = []
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+                result.append(ArchiveEntry(record["t"], record["url"], record["sha256"]))
+            except (ValueError, KeyError):
+                continue  # A line cut short by a crash
+    result.sort(key=lambda entry: entry.fetched_at)
+    return result
+
+
+def pages_at(urls: List[str], when: Optional[float] = None, root: str = PAGE_ARCHIVE_DIR) -> Dict[str, bytes]:
+    """
+    For each URL, the last page archived at or before `when` (defaults to the newest
+    entry). URLs with no archived page are left out.
+    """
+    latest: Dict[str, ArchiveEntry] = {}
+    for entry in entries(root):
+        if when is not None and entry.fetched_at > when:
+            break
+        latest[entry.url] = entry
+    return {url: load(latest[url].content_hash, root) for url in urls if url in latest}
+
+
+def latest_fetch_time(root: str = PAGE_ARCHIVE_DIR) -> Optional[float]:
+    archived = entries(root)
+    return archived[-1].fetched_at if archived else None
+
+
+def iter_pages(root: str = PAGE_ARCHIVE_DIR) -> Iterator[ArchiveEntry]:
+    """Every distinct archived page once, in the order it was first seen."""
+    seen = set()
+    for entry in entries(root):
+        if entry.content_hash not in seen:
+            seen.add(entry.content_hash)
+            yield entry
+
+
+# --- Retention ---
+
+def prune(root: str = PAGE_ARCHIVE_DIR, retention_days: float = PAGE_ARCHIVE_RETENTION_DAYS,
+          max_mb: float = PAGE_ARCHIVE_MAX_MB) -> Dict[str, int]:
+    """
+    Forgets fetches older than `retention_days`, then the oldest ones until the stored
+    pages fit in `max_mb`, and deletes pages no remaining fetch refers to.
+    """
+    if not root or not os.path.isdir(root):
+        return {"entries": 0, "pages": 0, "bytes": 0, "deleted_pages": 0}
+    with _lock:
+        cutoff = time.time() - retention_days * 24 * 60 * 60
+        kept = [entry for entry in entries(root) if entry.fetched_at >= cutoff]
+
+        sizes = {}
+        for entry in kept:
+            if entry.content_hash not in sizes:
+                path = _object_path(entry.content_hash, root)
+                sizes[entry.content_hash] = os.path.getsize(path) if os.path.exists(path) else 0
+        # Drop the oldest fetches until the pages the rest refer to fit in the budget.
+        references: Dict[str, int] = {}
+        for entry in kept:
+            references[entry.content_hash] = references.get(entry.content_hash, 0) + 1
+        total = sum(sizes.values())
+        start = 0
+        while total > max_mb * 1024 * 1024 and start < len(kept):
+            content_hash = kept[start].content_hash
+            references[content_hash] -= 1
+            if not references[content_hash]:
+                total -= sizes.pop(content_hash)
+            start += 1
+        kept = kept[start:]
+
+        lines = "".join(json.dumps({"t": entry.fetched_at, "url": entry.url, "sha256": entry.content_hash}) + "\n"
+                        for entry in kept)
+        _write_atomic(os.path.join(root, INDEX_FILE), lines.encode())
+
+        deleted = 0
+        objects = os.path.join(root, "objects")
+        for directory, _, files in os.walk(objects):
+            for name in files:
+                if name.split(".")[0] not in sizes:
+                    os.remove(os.path.join(directory, name))
+                    deleted += 1
+    return {"entries": len(kept), "pages": len(sizes), "bytes": total, "deleted_pages": deleted}
+
+
+# --- Command Line ---
+
+def _reparse(engine: str, root: str) -> int:
+    import parsers  # Only the CLI needs the parsers
+
+    failures = pages = rows = 0
+    start = time.perf_counter()
+    for entry in iter_pages(root):
+        html = load(entry.content_hash, root)
+        rows += len(parsers.parse(html, engine))
+        pages += 1
+        if engine != "bs4" and not parsers.check_parity(html, engine):
+            failures += 1
+            print(f"❌ {entry.content_hash} ({entry.url}, "
+                  f"{datetime.fromtimestamp(entry.fetched_at):%Y-%m-%d %H:%M}): '{engine}' differs from bs4")
+    elapsed = time.perf_counter() - start
+    print(f"Parsed {pages} archived pages ({rows} rows) with '{engine}' in {elapsed:.2f}s"
+          + (f", {failures} parity failures." if engine != "bs4" else "."))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect, re-parse or prune the calendar page archive.")
+    parser.add_argument("command", choices=["stats", "reparse", "prune"])
+    parser.add_argument("--root", default=PAGE_ARCHIVE_DIR)
+    parser.add_argument("--engine", default="lxml", help="parser engine for reparse")
+    args = parser.parse_args()
+
+    if args.command == "stats":
+        archived = entries(args.root)
+        pages = list(iter_pages(args.root))
+        stored = sum(os.path.getsize(_object_path(entry.content_hash, args.root)) for entry in pages)
+        print(f"{len(archived)} fetches of {len(pages)} distinct pages, {stored // 1024} KB compressed.")
+        if archived:
+            print(f"From {datetime.fromtimestamp(archived[0].fetched_at):%Y-%m-%d %H:%M} "
+                  f"to {datetime.fromtimestamp(archived[-1].fetched_at):%Y-%m-%d %H:%M}.")
+    elif args.command == "reparse":
+        sys.exit(1 if _reparse(args.engine, args.root) else 0)
+    else:
+        print(prune(args.root))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+# parsers.py
+
+import json
+import logging
+import os
+import sys
+from typing import Callable, Dict, List
+
+from bs4 import BeautifulSoup, UnicodeDammit
+from lxml import etree, html as lxml_html
+
+from slot import Slot
+
+# Get the logger
+logger = logging.getLogger(__name__)
+
+# The coach header colour is the one thing every calendar page with slots contains.
+# We use it to tell an empty week apart from markup the fast engine could not read.
+CALENDAR_MARKER = b"#ffff66"
+
+
+def _class_test(name: str) -> str:
+    """XPath predicate matching one token of the class attribute, like BeautifulSoup's class_=."""
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+
+# --- BeautifulSoup engine (reference implementation) ---
+
+def parse_with_bs4(html: bytes) -> List[Slot]:
+    """
+    Parses the HTML using a robust "bottom-up" approach.
+    This is the original pure-Python parser and the reference the other engines must match.
+    """
+    if not html:
+        return []
+
+    soup = BeautifulSoup(html, 'html.parser')
+    schedule = []
+    coach_headers = soup.find_all('tr', {'height': '24', 'bgcolor': '#ffff66'})
+
+    if not coach_headers:
+        logger.warning("Parser did not find any coach header rows. The page might be empty or changed.")
+        return []
+
+    for header in coach_headers:
+        coach_name_tag = header.find('a', class_='maintext')
+        if not coach_name_tag or "Coach:" not in coach_name_tag.text:
+            continue
+        current_coach = coach_name_tag.text.replace("Coach:", "").strip()
+
+        day_column = header.find_parent('td', class_='tdborder')
+        if not day_column:
+            continue
+
+        day_header = day_column.find('tr', {'height': '34'})
+        if not day_header:
+            continue
+
+        day_tag = day_header.find('a', class_='mainbold')
+        date_tag = day_header.find('a', class_='smallbold')
+        day_of_week = day_tag.text.strip() if day_tag else "Unknown"
+        full_date = date_tag.text.strip() if date_tag else "Unknown"
+
+        for slot_row in header.find_next_siblings('tr'):
+            columns = slot_row.find_all('td', class_='tdborder', recursive=False)
+            if len(columns) == 2:
+                time = columns[0].text.strip()
+                schedule.append(Slot(day_of_week, full_date, current_coach, time, bool(columns[1].find('input'))))
+
+    return schedule
+
+
+# --- lxml engine (compiled XPath) ---
+
+_COACH_HEADERS = etree.XPath("//tr[@height='24' and @bgcolor='#ffff66']")
+_COACH_NAME = etree.XPath(f"(.//a[{_class_test('maintext')}])[1]")
+_DAY_COLUMN = etree.XPath(f"ancestor::td[{_class_test('tdborder')}][1]")
+_DAY_HEADER = etree.XPath("(.//tr[@height='34'])[1]")
+_DAY_NAME = etree.XPath(f"(.//a[{_class_test('mainbold')}])[1]")
+_DATE = etree.XPath(f"(.//a[{_class_test('smallbold')}])[1]")
+_SLOT_ROWS = etree.XPath("following-sibling::tr")
+_SLOT_COLUMNS = etree.XPath(f"td[{_class_test('tdborder')}]")
+_HAS_INPUT = etree.XPath("boolean(.//input)")
+# BeautifulSoup's .text leaves out comments, <script> and <style>, so we do the same.
+_TEXT = etree.XPath(".//text()[not(parent::script) and not(parent::style)]")
+
+
+def _text(element) -> str:
+    return "".join(_TEXT(element))
+
+
+def parse_with_lxml(html: bytes) -> List[Slot]:
+    """
+    Same walk as parse_with_bs4, expressed as precompiled XPath over libxml2's tree.
+    Day headers are resolved once per day column instead of once per coach.
+    """
+    if not html:
+        return []
+
+    # Decode the same way BeautifulSoup does so both engines see identical text.
+    markup = UnicodeDammit(html, is_html=True).unicode_markup
+    if not markup or not markup.strip():
+        return []
+    root = lxml_html.document_fromstring(markup)
+
+    schedule = []
+    coach_headers = _COACH_HEADERS(root)
+    if not coach_headers:
+        logger.warning("Parser did not find any coach header rows. The page might be empty or changed.")
+        return []
+
+    day_cache = {}
+    for header in coach_headers:
+        coach_name_tag = _COACH_NAME(header)
+        if not coach_name_tag:
+            continue
+        coach_text = _text(coach_name_tag[0])
+        if "Coach:" not in coach_text:
+            continue
+        current_coach = coach_text.replace("Coach:", "").strip()
+
+        day_column = _DAY_COLUMN(header)
+        if not day_column:
+            continue
+        day_column = day_column[0]
+
+        if day_column not in day_cache:
+            day_header = _DAY_HEADER(day_column)
+            if not day_header:
+                day_cache[day_column] = None
+            else:
+                day_tag = _DAY_NAME(day_header[0])
+                date_tag = _DATE(day_header[0])
+                day_cache[day_column] = (
+                    _text(day_tag[0]).strip() if day_tag else "Unknown",
+                    _text(date_tag[0]).strip() if date_tag else "Unknown",
+                )
+        day_info = day_cache[day_column]
+        if day_info is None:
+            continue
+        day_of_week, full_date = day_info
+
+        for slot_row in _SLOT_ROWS(header):
+            columns = _SLOT_COLUMNS(slot_row)
+            if len(columns) == 2:
+                time = _text(columns[0]).strip()
+                schedule.append(Slot(day_of_week, full_date, current_coach, time, _HAS_INPUT(columns[1])))
+
+    return schedule
+
+
+PARSER_ENGINES: Dict[str, Callable[[bytes], List[Slot]]] = {
+    'lxml': parse_with_lxml,
+    'bs4': parse_with_bs4,
+}
+
+
+def parse(html: bytes, engine: str = 'lxml') -> List[Slot]:
+    """
+    Parses a calendar page with the requested engine. If a fast engine fails on the
+    markup, or finds nothing on a page that clearly has coach rows, we fall back to bs4.
+    """
+    if engine not in PARSER_ENGINES:
+        raise ValueError(f"Unknown parser engine '{engine}'. Choose one of: {', '.join(PARSER_ENGINES)}")
+
+    if engine == 'bs4':
+        return parse_with_bs4(html)
+
+    try:
+        schedule = PARSER_ENGINES[engine](html)
+    except (etree.LxmlError, ValueError) as e:
+        logger.warning(f"Parser engine '{engine}' failed on this page ({e}). Falling back to bs4.")
+        return parse_with_bs4(html)
+
+    if not schedule and html and CALENDAR_MARKER in html:
+        logger.warning(f"Parser engine '{engine}' found no slots on a page with coach rows. Falling back to bs4.")
+        return parse_with_bs4(html)
+    return schedule
+
+
+# --- Parity Check ---
+
+# Saved calendar pages (page.html) with the rows they must parse into (page.json).
+GOLDEN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "golden_pages")
+
+
+def check_parity(html: bytes, engine: str = 'lxml') -> bool:
+    """Returns True if `engine` yields exactly the same rows as the bs4 reference for this page."""
+    return PARSER_ENGINES[engine](html) == parse_with_bs4(html)
+
+
+def check_golden(directory: str = GOLDEN_DIR) -> List[str]:
+    """Parses every golden page with every engine. Returns a description of each mismatch."""
+    failures = []
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(".html"):
+            continue
+        path = os.path.join(directory, name)
+        with open(path, 'rb') as f:
+            page = f.read()
+        with open(path[:-len(".html")] + ".json") as f:
+            expected = json.load(f)
+        for engine, parse_page in PARSER_ENGINES.items():
+            rows = [slot.to_dict() for slot in parse_page(page)]
+            if rows != expected:
+                failures.append(f"{name}: '{engine}' parsed {len(rows)} rows, {len(expected)} expected"
+                                + next((f"; first difference at row {index}: {row}"
+                                        for index, row in enumerate(rows) if index >= len(expected)
+                                        or row != expected[index]), ""))
+    return failures
+
+
+def record_golden(path: str):
+    """Writes the bs4 rows of a saved page next to it as its expected output. Review them before committing."""
+    with open(path, 'rb') as f:
+        rows = [slot.to_dict() for slot in parse_with_bs4(f.read())]
+    with open(os.path.splitext(path)[0] + ".json", 'w') as f:
+        json.dump(rows, f, indent=1, ensure_ascii=False)
+        f.write("\n")
+
+
+if __name__ == '__main__':
+    # Usage: python parsers.py                        # every engine against the golden pages
+    #        python parsers.py page.html [...]        # every engine against bs4 on other saved pages
+    #        python parsers.py --record page.html     # write page.json, the expected rows of a new golden page
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+    if sys.argv[1:2] == ['--record']:
+        for path in sys.argv[2:]:
+            record_golden(path)
+        sys.exit(0)
+    if not sys.argv[1:]:
+        golden_failures = check_golden()
+        for failure in golden_failures:
+            print(f"❌ {failure}")
+        if not golden_failures:
+            print(f"✅ Every engine matches the golden pages in {GOLDEN_DIR}")
+        sys.exit(1 if golden_failures else 0)
+    failures = 0
+    for path in sys.argv[1:]:
+        with open(path, 'rb') as f:
+            page = f.read()
+        expected = parse_with_bs4(page)
+        for name, parse_page in PARSER_ENGINES.items():
+            if parse_page(page) == expected:
+                print(f"✅ {path}: '{name}' matches bs4 ({len(expected)} rows)")
+            else:
+                failures += 1
+                print(f"❌ {path}: '{name}' differs from bs4")
+    sys.exit(1 if failures else 0)
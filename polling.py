@@ -0,0 +1,132 @@
+# polling.py
+
+import logging
+import random
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+
+from calendars import Calendar, all_calendars
+from config import (
+    POLL_MIN_SECONDS, POLL_MAX_SECONDS, POLL_BACKOFF_FACTOR, POLL_JITTER, RELEASE_WINDOWS,
+    RELEASE_WINDOW_LEAD_MINUTES,
+)
+from matcher import DAY_NAMES, parse_minutes
+from scheduler import CheckResult
+
+# Get the logger
+logger = logging.getLogger(__name__)
+
+JOB_ID = "adaptive_poll"
+
+
+def in_release_window(now: datetime, windows: List[Tuple[str, str, str]] = RELEASE_WINDOWS,
+                      lead_minutes: int = RELEASE_WINDOW_LEAD_MINUTES) -> bool:
+    """
+    True if `now` (UTC) falls inside, or shortly before, one of the configured windows when
+    coaches usually publish or cancel slots. Windows are (day name or "*", "HH:MM", "HH:MM").
+    """
+    minute = now.hour * 60 + now.minute
+    for day, start, end in windows:
+        if day != "*" and day != DAY_NAMES[now.weekday()]:
+            continue
+        start_minute, end_minute = parse_minutes(start), parse_minutes(end)
+        if start_minute is None or end_minute is None:
+            continue
+        if start_minute - lead_minutes <= minute <= end_minute:
+            return True
+    return False
+
+
+class AdaptivePoller:
+    """
+    Runs the check on a cadence that follows the calendar's activity.
+
+    Every change resets the interval to `min_interval`. Each run without a change, or
+    with an upstream error, multiplies it by `backoff` up to `max_interval`. Inside a
+    release window we never wait longer than `min_interval`. A run never starts while
+    the previous one is still going, and every delay gets some random jitter so we do
+    not hit the site on an exact beat.
+
+    Each poller needs its own `job_id` when several run on one scheduler.
+    """
+
+    def __init__(self, scheduler: AsyncIOScheduler, check: Callable[[], Awaitable[CheckResult]],
+                 min_interval: float = POLL_MIN_SECONDS, max_interval: float = POLL_MAX_SECONDS,
+                 backoff: float = POLL_BACKOFF_FACTOR, jitter: float = POLL_JITTER, job_id: str = JOB_ID):
+        self.scheduler = scheduler
+        self.check = check
+        self.job_id = job_id
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.jitter = jitter
+        self.interval = min_interval
+        self._running = False
+        self._stopped = False
+
+    def start(self, delay: float = 0):
+        """Schedules the first run `delay` seconds from now."""
+        self._stopped = False
+        self.interval = self.min_interval
+        self._schedule(delay)
+        logger.info(f"Adaptive polling '{self.job_id}' started ({int(self.min_interval)}s to {int(self.max_interval)}s).")
+
+    def stop(self):
+        """Cancels the next run. A run already in progress finishes but does not schedule another."""
+        self._stopped = True
+        if self.scheduler.get_job(self.job_id) is not None:
+            self.scheduler.remove_job(self.job_id)
+        logger.info(f"Adaptive polling '{self.job_id}' stopped.")
+
+    def _schedule(self, delay: float):
+        run_date = datetime.now(timezone.utc) + timedelta(seconds=delay)
+        # Only a run schedules the next one, so a run must never be dropped as missed when the
+        # event loop is late (APScheduler's default grace time is one second).
+        self.scheduler.add_job(self._run, 'date', run_date=run_date, id=self.job_id, replace_existing=True,
+                               misfire_grace_time=None, coalesce=True)
+
+    def next_interval(self, result: Optional[CheckResult], now: datetime) -> float:
+        """Works out the wait before the next run from the outcome of this one."""
+        if result is not None and result.changed and not result.failed:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * self.backoff, self.max_interval)
+        delay = self.interval
+        if in_release_window(now):
+            delay = min(delay, self.min_interval)
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    async def _run(self):
+        if self._running:
+            logger.info("Skipping poll: the previous check is still running.")
+            return
+        self._running = True
+        result = None
+        try:
+            result = await self.check()
+        except Exception as e:
+            logger.error(f"Scheduled check failed: {e}")
+        finally:
+            self._running = False
+            if not self._stopped:
+                delay = self.next_interval(result, datetime.now(timezone.utc))
+                logger.info(f"Next '{self.job_id}' check in {int(delay)}s.")
+                self._schedule(delay)
+
+
+def calendar_pollers(scheduler: AsyncIOScheduler,
+                     check: Callable[[Calendar], Awaitable[CheckResult]]) -> List[AdaptivePoller]:
+    """
+    One poller per configured calendar, each on that calendar's own cadence. `check` is
+    called with the calendar to poll. The pollers are not started.
+    """
+    def poll(calendar: Calendar) -> Callable[[], Awaitable[CheckResult]]:
+        return lambda: check(calendar)
+
+    return [
+        AdaptivePoller(scheduler, poll(calendar), min_interval=calendar.poll_min_seconds,
+                       max_interval=calendar.poll_max_seconds, job_id=f"{JOB_ID}:{calendar.id}")
+        for calendar in all_calendars()
+    ]
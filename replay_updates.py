@@ -0,0 +1,95 @@
+# replay_updates.py
+#
+# Posts recorded Telegram updates to a bot running in webhook mode, the way Telegram
+# would, and reports how quickly they were accepted:
+#
+#   UPDATE_RECORD_DIR=updates python bot.py           # record real traffic (any mode)
+#   UPDATE_MODE=webhook WEBHOOK_URL=https://... WEBHOOK_SECRET_TOKEN=s3cret CONCURRENT_UPDATES=16 python bot.py
+#   python replay_updates.py updates/ --secret s3cret --concurrency 40 --repeat 10
+#
+# Each file holds one update as JSON (update.to_dict()). Replayed callback queries are
+# stale to Telegram, so answering them fails; the handlers still run in full.
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+from typing import Dict, List
+
+import httpx
+
+from config import WEBHOOK_PATH, WEBHOOK_PORT, WEBHOOK_SECRET_TOKEN
+
+
+def load_updates(paths: List[str]) -> List[Dict]:
+    """Reads every .json file given, or found in a given directory, in update_id order."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name) for name in os.listdir(path) if name.endswith(".json"))
+        else:
+            files.append(path)
+    updates = []
+    for file in files:
+        with open(file) as f:
+            updates.append(json.load(f))
+    return sorted(updates, key=lambda update: update.get("update_id", 0))
+
+
+async def replay(url: str, secret: str, updates: List[Dict], concurrency: int) -> Dict[str, object]:
+    """Posts the updates with at most `concurrency` requests in flight."""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    statuses: Dict[int, int] = {}
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+
+    async with httpx.AsyncClient(timeout=30, limits=httpx.Limits(max_connections=concurrency)) as client:
+        async def post(update: Dict):
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    response = await client.post(url, json=update, headers=headers)
+                    status = response.status_code
+                except httpx.HTTPError:
+                    status = 0
+                latencies.append(time.perf_counter() - start)
+                statuses[status] = statuses.get(status, 0) + 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(post(update) for update in updates))
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "updates": len(updates),
+        "statuses": statuses,
+        "per_second": round(len(updates) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(statistics.median(latencies) * 1000, 1) if latencies else 0.0,
+        "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 1) if latencies else 0.0,
+        "max_ms": round(latencies[-1] * 1000, 1) if latencies else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded updates against the webhook.")
+    parser.add_argument("paths", nargs="+", help="update JSON files or directories of them")
+    parser.add_argument("--url", default=f"http://127.0.0.1:{WEBHOOK_PORT}/{WEBHOOK_PATH}")
+    parser.add_argument("--secret", default=WEBHOOK_SECRET_TOKEN, help="defaults to WEBHOOK_SECRET_TOKEN")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=1, help="send the whole set this many times")
+    args = parser.parse_args()
+
+    updates = load_updates(args.paths) * args.repeat
+    if not updates:
+        sys.exit("No updates found.")
+    result = asyncio.run(replay(args.url, args.secret, updates, args.concurrency))
+    print(json.dumps(result, indent=2))
+    if set(result["statuses"]) != {200}:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
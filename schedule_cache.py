@@ -0,0 +1,165 @@
+# schedule_cache.py
+
+import asyncio
+import functools
+import logging
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from config import SCHEDULE_CACHE_TTL_SECONDS, SCHEDULE_CACHE_MAX_STALE_SECONDS
+import database as db
+import scraper
+from calendars import all_calendars
+from coach_directory import coach_directory
+from metrics import metrics
+from slot import Slot
+
+# Get the logger
+logger = logging.getLogger(__name__)
+
+
+class ScheduleSnapshot:
+    """
+    One parsed copy of the calendar and the time it was fetched.
+    `changed` is True if any calendar page differed from the previous fetch, and
+    `opened_slots` are the slots that became available since the previous snapshot.
+    """
+
+    def __init__(self, schedule: List[Slot], fetched_at: float,
+                 opened_slots: Optional[List[Slot]] = None, changed: bool = False):
+        self.schedule = schedule
+        self.fetched_at = fetched_at
+        self.opened_slots = opened_slots or []
+        self.changed = changed
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.fetched_at
+
+    @property
+    def available_slots(self) -> List[Slot]:
+        return [slot for slot in self.schedule if slot.available]
+
+
+def find_opened_slots(schedule: List[Slot], calendar_id: str) -> List[Slot]:
+    """
+    Compares a calendar's schedule with its stored slot snapshot, stores the new one, and
+    returns the slots that are available now but were booked or missing before.
+    """
+    previous = db.get_slot_snapshot(calendar_id)
+    current = {slot.key: slot.available for slot in schedule}
+    opened = [slot for slot in schedule if slot.available and not previous.get(slot.key, False)]
+    if current != previous:
+        db.replace_slot_snapshot(current, calendar_id)
+    return opened
+
+
+class ScheduleCache:
+    """
+    Keeps the last parsed schedule of one calendar in memory for `ttl` seconds.
+
+    Callers that arrive while a refresh is running wait for that refresh instead of
+    starting their own, so a burst of new alerts costs a single scrape. If the site
+    errors, the previous snapshot is served for up to `max_stale` seconds.
+
+    Working out which slots opened updates the stored slot snapshot, so only callers that
+    match the openings against every alert may do it. A refresh for anyone else leaves
+    the openings for the next refresh that does.
+    """
+
+    def __init__(self, fetch: Callable[[], Awaitable[scraper.ScheduleFetch]], calendar_id: str,
+                 ttl: float = SCHEDULE_CACHE_TTL_SECONDS,
+                 max_stale: float = SCHEDULE_CACHE_MAX_STALE_SECONDS):
+        self._fetch = fetch
+        self.calendar_id = calendar_id
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self._snapshot: Optional[ScheduleSnapshot] = None
+        self._refresh_task: Optional[asyncio.Task] = None
+        self._failed_at: Optional[float] = None
+        # A refresh saw changed pages but left finding the opened slots to a later one.
+        self._opened_pending = False
+
+    def set_source(self, fetch: Callable[[], Awaitable[scraper.ScheduleFetch]]):
+        """Replaces where refreshes get the schedule from (see cluster.py)."""
+        self._fetch = fetch
+
+    def install(self, schedule: List[Slot]):
+        """Makes a schedule obtained elsewhere (a snapshot another instance published) the current one."""
+        self._snapshot = ScheduleSnapshot(schedule, time.monotonic())
+        self._failed_at = None
+
+    @property
+    def last_refresh_failed(self) -> bool:
+        return self._failed_at is not None
+
+    @property
+    def snapshot(self) -> Optional[ScheduleSnapshot]:
+        """The last snapshot we have, however old. Never touches the network."""
+        return self._snapshot
+
+    async def get(self, max_age: Optional[float] = None, find_opened: bool = True) -> Optional[ScheduleSnapshot]:
+        """
+        Returns a snapshot no older than `max_age` (defaults to the TTL), refreshing it if needed.
+        Returns None if the site is down and there is no usable stale copy.
+
+        Pass `find_opened=False` when the caller will not notify every alert of the slots
+        that opened; a refresh it starts then reports none and leaves them to the next one.
+        """
+        max_age = self.ttl if max_age is None else max_age
+        if self._snapshot is not None and self._snapshot.age <= max_age:
+            metrics.inc("schedule_cache_total", result="hit")
+            return self._snapshot
+        # After a failed refresh, give the site a TTL's rest before trying again.
+        if self._failed_at is not None and time.monotonic() - self._failed_at < self.ttl and self._usable_stale():
+            metrics.inc("schedule_cache_total", result="stale")
+            return self._snapshot
+
+        if self._refresh_task is None:
+            metrics.inc("schedule_cache_total", result="refresh")
+            self._refresh_task = asyncio.create_task(self._refresh(find_opened))
+        else:
+            metrics.inc("schedule_cache_total", result="joined")
+            logger.info("Joining the schedule refresh that is already in progress.")
+        # Shield the shared task so one cancelled caller does not cancel it for everyone.
+        return await asyncio.shield(self._refresh_task)
+
+    async def _refresh(self, find_opened: bool) -> Optional[ScheduleSnapshot]:
+        try:
+            with metrics.span("schedule_fetch", calendar=self.calendar_id):
+                result = await self._fetch()
+            changed = result.changed or self._opened_pending
+            opened = []
+            if changed and find_opened:
+                opened = await db.run_async(find_opened_slots, result.schedule, self.calendar_id)
+                self._opened_pending = False
+            elif changed:
+                self._opened_pending = True
+                changed = False
+            self._snapshot = ScheduleSnapshot(result.schedule, time.monotonic(), opened, changed)
+            self._failed_at = None
+            await coach_directory.observe(self.calendar_id, result.schedule)
+            return self._snapshot
+        except Exception as e:
+            self._failed_at = time.monotonic()
+            if self._usable_stale():
+                logger.warning(f"Schedule refresh failed ({e}). Serving a snapshot from "
+                               f"{int(self._snapshot.age)}s ago.")
+                # The stale copy carries no new openings; they were handled when it was fresh.
+                self._snapshot.opened_slots = []
+                self._snapshot.changed = False
+                return self._snapshot
+            logger.error(f"Schedule refresh failed and no recent snapshot is available. Exception: {e}")
+            return None
+        finally:
+            self._refresh_task = None
+
+    def _usable_stale(self) -> bool:
+        return self._snapshot is not None and self._snapshot.age <= self.max_stale
+
+
+# The process-wide caches used by the scheduler and the bot, one per configured calendar.
+schedule_caches: Dict[str, ScheduleCache] = {
+    calendar.id: ScheduleCache(functools.partial(scraper.fetch_schedule, calendar=calendar), calendar.id)
+    for calendar in all_calendars()
+}
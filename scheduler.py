@@ -1,75 +1,338 @@
 # scheduler.py
 
 from telegram import Bot
-from scraper import get_available_classes
-from database import get_all_alerts, add_sent_notification, has_notification_been_sent  # Updated import
-from datetime import datetime
+from telegram.error import BadRequest, Forbidden
+from config import OUTBOX_BATCH_SIZE, OUTBOX_LEASE_SECONDS, OUTBOX_MAX_ATTEMPTS
+from digest import build_digests
+import page_archive
+from dispatcher import Notification, NotificationDispatcher
+from calendars import get_calendar
+from schedule_cache import schedule_caches
+from slot import Slot
+from database import (
+    get_matching_alerts, get_unsent_notifications, add_sent_notifications, compact_database, run_async,
+    enqueue_outbox, claim_outbox, finish_outbox, get_alert, PublishedSnapshot,
+)
+from matcher import Alert, AlertMatcher, slot_day_mask
+from metrics import metrics
+import asyncio
 import logging
+from datetime import datetime
+from typing import Callable, Dict, List, NamedTuple, Optional, Set, Tuple
 
 # Get the logger
 logger = logging.getLogger(__name__)
 
+# Slots whose notification failed to send. They are matched again on the next run even
+# if the calendar has not changed, so a Telegram hiccup does not lose the alert.
+_retry_slots = {}
+# (chat_id, notification_key) pairs another run is sending right now. Checked together
+# with the batch dedup query so overlapping runs do not both send the same alert.
+_in_flight = set()
 
-def is_time_in_range(time_str: str, time_range_str: str) -> bool:
-    """Checks if a time (HH:MM) is within a given range (e.g., '16:00-18:00')."""
-    try:
-        slot_time = datetime.strptime(time_str.split('-')[0].strip(), "%H:%M").time()
-        start_str, end_str = time_range_str.split('-')
-        start_time = datetime.strptime(start_str, "%H:%M").time()
-        end_time = datetime.strptime(end_str, "%H:%M").time()
-        return start_time <= slot_time <= end_time
-    except (ValueError, IndexError):
-        return False
+# One dispatcher per bot, so all runs share the same queue and rate limits.
+_dispatchers: Dict[int, NotificationDispatcher] = {}
+
+
+def get_dispatcher(bot: Bot) -> NotificationDispatcher:
+    dispatcher = _dispatchers.get(id(bot))
+    if dispatcher is None:
+        dispatcher = _dispatchers[id(bot)] = NotificationDispatcher(bot)
+    return dispatcher
+
+
+async def close_dispatchers():
+    """Stops the notification workers of every bot."""
+    for dispatcher in _dispatchers.values():
+        await dispatcher.close()
+    _dispatchers.clear()
 
 
-async def check_and_notify_all_users(bot: Bot, triggered_by: str = "scheduled check"):
+def slot_priority(slot: Slot) -> float:
+    """Sort key for notifications: the slot's start as a timestamp, so the soonest slots go first."""
+    slot_date = slot.slot_date
+    if slot_date is None:
+        return float('inf')
+    return datetime(slot_date.year, slot_date.month, slot_date.day).timestamp() + (slot.start_minute or 0) * 60
+
+
+class CheckResult(NamedTuple):
+    """What a check found, used by the adaptive poller to pick the next interval."""
+    changed: bool = False  # The calendar differed from the previous fetch
+    failed: bool = False  # The site could not be scraped
+    notified: int = 0  # Slot matches delivered to users
+
+
+async def check_and_notify_all_users(bot: Optional[Bot], triggered_by: str = "scheduled check",
+                                     full_check: bool = False, max_age: Optional[float] = None,
+                                     calendar_id: Optional[str] = None) -> CheckResult:
     """
-    Fetches classes, checks against user alerts, and sends notifications
-    only if they haven't been sent before.
+    Fetches classes of one calendar (the default one if not given), checks against the
+    alerts on that calendar, and sends notifications only if they haven't been sent
+    before. With `bot=None` (the worker process) the messages are queued in the outbox
+    for the bot process to deliver instead.
+
+    By default only slots that opened since the previous check are matched. Pass
+    `full_check=True` to match every available slot (e.g. right after a new alert).
+    `max_age` limits how old a cached schedule may be (defaults to the cache TTL).
     """
-    logger.info(f"Running check for classes, triggered by: {triggered_by}...")
+    calendar_id = get_calendar(calendar_id).id
+    logger.info(f"Running check for classes on '{calendar_id}', triggered by: {triggered_by}...")
+    with metrics.span("check", calendar=calendar_id, full=full_check):
+        return await _check(bot, full_check, max_age, calendar_id)
+
+
+async def _check(bot: Optional[Bot], full_check: bool, max_age: Optional[float], calendar_id: str) -> CheckResult:
+    cache = schedule_caches[calendar_id]
+    snapshot = await cache.get(max_age)
+    if snapshot is None:
+        logger.info("Check complete: The schedule could not be fetched.")
+        return CheckResult(failed=True)
+    result = CheckResult(changed=snapshot.changed, failed=cache.last_refresh_failed)
+
+    if full_check:
+        available_slots = snapshot.available_slots
+    else:
+        available_slots = _opened_and_retried(snapshot.opened_slots, snapshot.available_slots)
+        if not available_slots:
+            logger.info("Check complete: No slots have opened since the last check.")
+            return result
 
-    available_slots = get_available_classes()
     if not available_slots:
         logger.info("Check complete: No available slots found on the website.")
-        return
+        return result
+    return await _match_and_notify(bot, available_slots, result, calendar_id)
 
-    all_alerts = get_all_alerts()
-    if not all_alerts:
-        logger.info("Check complete: No user alerts are currently set in the database.")
-        return
 
-    notifications_sent = 0
-    for alert in all_alerts:
-        alert_id, chat_id, coach, days, time_range = alert
-
-        for slot in available_slots:
-            if (coach.lower() in slot['coach'].lower() and
-                    slot['day'] in days and
-                    is_time_in_range(slot['time'], time_range)):
-
-                # Create a unique key for the notification to prevent duplicates.
-                notification_key = f"{slot['coach']}-{slot['date']}-{slot['time']}"
-
-                # --- NEW DUPLICATE CHECK ---
-                if not has_notification_been_sent(chat_id, notification_key):
-                    message = (
-                        f"🔔 **Class Available!**\n\n"
-                        f"**Coach:** {slot['coach']}\n"
-                        f"**Day:** {slot['day']}, {slot['date']}\n"
-                        f"**Time:** {slot['time']}\n\n"
-                        f"This matches your alert for `{coach}` on `{days}` between `{time_range}`."
-                    )
-                    try:
-                        await bot.send_message(chat_id=chat_id, text=message, parse_mode='Markdown')
-                        # Record that this notification was sent successfully.
-                        add_sent_notification(chat_id, notification_key)
-                        notifications_sent += 1
-                        logger.info(f"Sent NEW notification to {chat_id} for {slot['coach']}.")
-                    except Exception as e:
-                        logger.error(f"Failed to send message to {chat_id}: {e}")
+async def check_published_snapshot(bot: Optional[Bot], snapshot: PublishedSnapshot,
+                                   owns_chat: Callable[[int], bool]) -> CheckResult:
+    """
+    Multi-instance mode: matches the slots that opened in a snapshot the leader published,
+    but only notifies the chats this instance owns (see cluster.py).
+    """
+    logger.info(f"Checking published snapshot {snapshot.id} of '{snapshot.calendar_id}' for this instance's chats...")
+    with metrics.span("check", calendar=snapshot.calendar_id, full=False):
+        result = CheckResult(changed=True)
+        available_slots = _opened_and_retried(snapshot.opened_slots,
+                                              [slot for slot in snapshot.schedule if slot.available])
+        if not available_slots:
+            logger.info("Check complete: No slots opened in this snapshot.")
+            return result
+        return await _match_and_notify(bot, available_slots, result, snapshot.calendar_id, owns_chat)
+
+
+def _opened_and_retried(opened_slots: List[Slot], available_slots: List[Slot]) -> List[Slot]:
+    """
+    The newly opened slots, plus this calendar's slots whose notification failed last
+    time and are still open. Both lists are slots of the same calendar.
+    """
+    candidates = {slot.key: slot for slot in opened_slots}
+    if _retry_slots and available_slots:
+        calendar_id = available_slots[0].calendar
+        still_open = {slot.key for slot in available_slots}
+        for key, slot in list(_retry_slots.items()):
+            if slot.calendar == calendar_id:
+                del _retry_slots[key]
+                if key in still_open:
+                    candidates[key] = slot
+    return list(candidates.values())
+
+
+async def _match_and_notify(bot: Optional[Bot], available_slots: List[Slot], result: CheckResult,
+                            calendar_id: str, owns_chat: Optional[Callable[[int], bool]] = None) -> CheckResult:
+    # Only the alerts that can match one of these slots are read, via the (coach, start minute) index.
+    slots = [slot for slot in available_slots if slot.start_minute is not None]
+    with metrics.span("match"):
+        matching = await run_async(get_matching_alerts, [
+            (slot.coach, slot_day_mask(slot.day), slot.start_minute) for slot in slots
+        ], calendar_id)
+    metrics.inc("slots_checked_total", len(slots))
+    metrics.inc("alerts_evaluated_total", len(matching))  # Only the candidate rows the index returned
+    metrics.inc("matches_total", len(matching))
+    if not matching:
+        logger.info("Check complete: No user alerts match the available slots.")
+        return result
+
+    # Collect every candidate first. Each (chat, slot) pair is kept once, even when
+    # several alerts of the same user match it.
+    candidates = {}
+    for slot_index, alert in matching:
+        slot = slots[slot_index]
+        chat_id = alert[1]
+        if owns_chat is not None and not owns_chat(chat_id):
+            continue
+        # Create a unique key for the notification to prevent duplicates.
+        candidates.setdefault((chat_id, slot.key), (alert, slot))
+    return await _notify(bot, candidates, result)
+
+
+async def notify_new_alert(bot: Optional[Bot], alert_id: int) -> CheckResult:
+    """Answers a newly created alert: matches just that alert and notifies just its chat."""
+    alert = await run_async(get_alert, alert_id)
+    if alert is None:  # Deleted again in the meantime
+        return CheckResult()
+    return await evaluate_alerts(bot, [alert], f"new alert {alert_id} from user {alert[1]}")
+
+
+async def evaluate_alerts(bot: Optional[Bot], alerts: List[Alert], triggered_by: str) -> CheckResult:
+    """
+    Matches only the given alerts against every available slot of their calendars' cached
+    schedules, then dedups and notifies only their chats. Nothing else is re-read or re-matched.
+
+    A schedule is not fetched again unless the cached one is older than its calendar's
+    longest poll interval, i.e. the poller has stopped keeping it fresh. Such a fetch
+    leaves the slots that opened in it to the next poll, which notifies every alert of them.
+    """
+    logger.info(f"Checking {len(alerts)} alert(s), triggered by: {triggered_by}...")
+    with metrics.span("alert_check"):
+        by_calendar: Dict[str, List[Alert]] = {}
+        for alert in alerts:
+            by_calendar.setdefault(alert[5], []).append(alert)
+
+        result = CheckResult()
+        candidates = {}
+        for calendar_id, calendar_alerts in by_calendar.items():
+            cache = schedule_caches.get(calendar_id)
+            if cache is None:
+                logger.warning(f"Skipping {len(calendar_alerts)} alert(s) on unknown calendar '{calendar_id}'.")
+                continue
+            snapshot = await cache.get(get_calendar(calendar_id).poll_max_seconds, find_opened=False)
+            if snapshot is None:
+                logger.info(f"The schedule of '{calendar_id}' could not be fetched.")
+                result = result._replace(failed=True)
+                continue
+            result = result._replace(changed=result.changed or snapshot.changed,
+                                     failed=result.failed or cache.last_refresh_failed)
+            metrics.inc("alerts_evaluated_total", len(calendar_alerts))
+            for alert, slot in AlertMatcher(calendar_alerts).match_all(snapshot.available_slots):
+                candidates.setdefault((alert[1], slot.key), (alert, slot))
+        metrics.inc("matches_total", len(candidates))
+        if not candidates:
+            logger.info("Alert check complete: No available slots match.")
+            return result
+        return await _notify(bot, candidates, result)
+
+
+async def _notify(bot: Optional[Bot], candidates: Dict[Tuple[int, str], Tuple[Alert, Slot]],
+                  result: CheckResult) -> CheckResult:
+    """Drops already-sent (chat, slot) candidates, then sends or queues one digest per chat."""
+    # --- DUPLICATE CHECK: one query for the whole run ---
+    unsent = await run_async(get_unsent_notifications, list(candidates)) - _in_flight
+    _in_flight.update(unsent)
+    metrics.inc("dedup_hits_total", len(candidates) - len(unsent))
+
+    # --- DIGEST: one message (or a few, if long) per chat ---
+    matches_by_chat = {}
+    for (chat_id, notification_key), (alert, slot) in candidates.items():
+        if (chat_id, notification_key) in unsent:
+            matches_by_chat.setdefault(chat_id, []).append((notification_key, slot, alert))
+
+    notifications = []
+    for chat_id, matches in matches_by_chat.items():
+        notifications.extend(build_digests(chat_id, matches, slot_priority))
+
+    if bot is None:
+        return result._replace(notified=await _queue_notifications(notifications, unsent))
+
+    sent = []
+    try:
+        with metrics.span("dispatch"):
+            delivered = await get_dispatcher(bot).dispatch(notifications)
+        for notification in delivered:
+            metrics.inc("messages_total", result="sent" if notification.sent else "failed")
+            if notification.sent:
+                sent.extend((notification.chat_id, key, slot.slot_date)
+                            for key, slot, _ in notification.payload)
+                logger.info(f"Sent NEW notification to {notification.chat_id} "
+                            f"covering {len(notification.payload)} slot(s).")
+            else:
+                if not isinstance(notification.error, (Forbidden, BadRequest)):
+                    _retry_slots.update({key: slot for key, slot, _ in notification.payload})
+                logger.error(f"Failed to send message to {notification.chat_id}: {notification.error}")
+    finally:
+        # Record every successful send in a single transaction, even if the run is interrupted.
+        await run_async(add_sent_notifications, sent)
+        _in_flight.difference_update(unsent)
+    notifications_sent = len(sent)
+    metrics.inc("notifications_sent_total", notifications_sent)
 
     if notifications_sent > 0:
-        logger.info(f"Check complete. Sent {notifications_sent} new notifications.")
+        logger.info(f"Check complete. Notified {notifications_sent} new slot matches "
+                    f"in {sum(n.sent for n in notifications)} messages.")
     else:
-        logger.info("Check complete. No new matching slots found for any users.")
\ No newline at end of file
+        logger.info("Check complete. No new matching slots found for any users.")
+    return result._replace(notified=notifications_sent)
+
+
+async def _queue_notifications(notifications: List[Notification], unsent: Set[Tuple[int, str]]) -> int:
+    """Worker process: hands the messages to the bot process through the outbox."""
+    sent = [(notification.chat_id, key, slot.slot_date)
+            for notification in notifications for key, slot, _ in notification.payload]
+    try:
+        await run_async(enqueue_outbox, [(notification.chat_id, notification.text, notification.parse_mode,
+                                          notification.priority) for notification in notifications], sent)
+    finally:
+        _in_flight.difference_update(unsent)
+    metrics.inc("outbox_queued_total", len(notifications))
+    metrics.inc("notifications_sent_total", len(sent))
+    if sent:
+        logger.info(f"Check complete. Queued {len(notifications)} messages covering {len(sent)} new slot matches.")
+    else:
+        logger.info("Check complete. No new matching slots found for any users.")
+    return len(sent)
+
+
+async def deliver_outbox(bot: Bot, limit: int = OUTBOX_BATCH_SIZE) -> int:
+    """
+    Bot process: sends the messages the worker queued and records each outcome.
+    Runs until the outbox is empty. Returns the number of messages delivered.
+    """
+    delivered_total = 0
+    while True:
+        messages = await run_async(claim_outbox, limit, OUTBOX_LEASE_SECONDS)
+        if not messages:
+            return delivered_total
+        notifications = [Notification(message.chat_id, message.text, priority=message.priority,
+                                      parse_mode=message.parse_mode, payload=message) for message in messages]
+        delivered, failed, retry = [], [], []
+        try:
+            with metrics.span("dispatch"):
+                await get_dispatcher(bot).dispatch(notifications)
+        finally:
+            # Messages that were never attempted (we were interrupted) come back when their lease expires.
+            for notification in notifications:
+                message = notification.payload
+                if notification.sent:
+                    delivered.append(message.id)
+                elif notification.error is None:
+                    continue
+                elif isinstance(notification.error, (Forbidden, BadRequest)) or message.attempts >= OUTBOX_MAX_ATTEMPTS:
+                    failed.append((message.id, str(notification.error)))
+                    logger.error(f"Giving up on message to {message.chat_id}: {notification.error}")
+                else:
+                    retry.append((message.id, str(notification.error), 30 * message.attempts))
+            await run_async(finish_outbox, delivered, failed, retry)
+        for result, ids in (("sent", delivered), ("failed", failed), ("retry", retry)):
+            if ids:
+                metrics.inc("messages_total", len(ids), result=result)
+        logger.info(f"Outbox: {len(delivered)} delivered, {len(failed)} failed, {len(retry)} to retry.")
+        delivered_total += len(delivered)
+        if len(messages) < limit:
+            return delivered_total
+
+
+async def compact_notification_history():
+    """
+    Scheduled job: drops notifications for past slots and keeps the database file small.
+    Also applies the page archive's retention limits.
+    """
+    stats = await run_async(compact_database)
+    logger.info(f"Database compaction done. Pruned {stats['pruned_notifications']} old notifications; "
+                f"{stats['sent_notifications_rows']} remain, file size {stats['file_bytes'] // 1024} KB.")
+    try:
+        archive = await asyncio.to_thread(page_archive.prune)
+    except OSError as e:
+        logger.warning(f"Could not prune the page archive: {e}")
+        return
+    logger.info(f"Page archive pruned: {archive['entries']} fetches of {archive['pages']} pages kept "
+                f"({archive['bytes'] // 1024} KB), {archive['deleted_pages']} pages deleted.")
@@ -1,113 +1,389 @@
 # scraper.py
 
-import requests
+import asyncio
+import hashlib
+import time
+import httpx
 import logging
-from bs4 import BeautifulSoup, Tag
-from typing import List, Dict
+import multiprocessing
+import database as db
+import page_archive
+from calendars import Calendar, get_calendar
+from coach_directory import coach_directory
+import parsers
+from metrics import metrics
+from slot import Slot, SLOT_DATE_FORMATS, parse_slot_date  # noqa: F401 (re-exported)
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Dict, List, NamedTuple, Optional, Tuple
 
 # Assumes config.py is in the same directory
-from config import BASE_CALENDAR_URL, COOKIE_URL
+from config import (
+    HTTP_TIMEOUT_SECONDS, COOKIE_MAX_AGE_SECONDS, FETCH_CONCURRENCY, PARSE_WORKERS, PARSER_ENGINE,
+    PAGE_ARCHIVE_DIR, SCRAPE_SOURCE, SCRAPE_REPLAY_AT, DEFAULT_CALENDAR_ID,
+)
 from datetime import date, datetime
 
 # Get the logger
 logger = logging.getLogger(__name__)
 
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
 
-def get_full_schedule() -> List[Dict[str, str]]:
+# --- Per-Calendar HTTP Sessions ---
+# Each calendar keeps one pooled client for the lifetime of the process, so the TLS
+# connection and the session cookie are reused between checks instead of being rebuilt
+# every run. Pages of all calendars share the fetch limit and the parse workers.
+_fetch_semaphore = asyncio.Semaphore(FETCH_CONCURRENCY)
+_parse_executor: Optional[Executor] = None
+
+
+class CalendarSession:
+    """The HTTP client and session cookie used for one calendar."""
+
+    def __init__(self, calendar: Calendar):
+        self.calendar = calendar
+        self.client: Optional[httpx.AsyncClient] = None
+        self.lock = asyncio.Lock()
+        self.cookie_acquired_at: Optional[float] = None
+
+    def get_client(self) -> httpx.AsyncClient:
+        """Returns the session's HTTP client, creating it on first use."""
+        if self.client is None or self.client.is_closed:
+            self.client = httpx.AsyncClient(
+                headers={"User-Agent": USER_AGENT},
+                timeout=HTTP_TIMEOUT_SECONDS,
+                follow_redirects=True,
+                limits=httpx.Limits(max_connections=10, max_keepalive_connections=5, keepalive_expiry=300),
+            )
+        return self.client
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+        self.client = None
+        self.cookie_acquired_at = None
+
+    def cookie_is_valid(self) -> bool:
+        """True if we hold a session cookie that has not expired yet."""
+        if self.cookie_acquired_at is None:
+            return False
+        if time.monotonic() - self.cookie_acquired_at > COOKIE_MAX_AGE_SECONDS:
+            return False
+        self.client.cookies.jar.clear_expired_cookies()
+        return len(self.client.cookies.jar) > 0
+
+    async def acquire_cookie(self):
+        """Visits the club's main site to (re)acquire the session cookie."""
+        logger.info(f"Acquiring session cookie from: {self.calendar.cookie_url}")
+        client = self.get_client()
+        client.cookies.clear()
+        with metrics.span("cookie_fetch", calendar=self.calendar.id):
+            cookie_response = await client.get(self.calendar.cookie_url)
+            cookie_response.raise_for_status()
+        self.cookie_acquired_at = time.monotonic()
+        logger.info("Successfully acquired session cookie.")
+
+    def is_rejected(self, response: httpx.Response) -> bool:
+        """
+        The calendar does not return a clean error when the session is missing or stale;
+        it either refuses the request or bounces us to another page.
+        """
+        if response.status_code in (401, 403, 440):
+            return True
+        return response.url.host != httpx.URL(self.calendar.calendar_url).host
+
+
+_sessions: Dict[str, CalendarSession] = {}
+
+
+def _get_session(calendar: Calendar) -> CalendarSession:
+    session = _sessions.get(calendar.id)
+    if session is None or session.calendar != calendar:
+        session = _sessions[calendar.id] = CalendarSession(calendar)
+    return session
+
+
+async def close_session():
+    """Closes every calendar's HTTP client and the parse workers. Safe to call even if they were never started."""
+    global _parse_executor
+    for session in _sessions.values():
+        await session.close()
+    _sessions.clear()
+    if _parse_executor is not None:
+        _parse_executor.shutdown(wait=False, cancel_futures=True)
+    _parse_executor = None
+
+
+class CalendarPage(NamedTuple):
+    """A fetched calendar page. `content` is empty when the server answered 304 Not Modified."""
+    url: str
+    content: bytes
+    not_modified: bool
+    etag: Optional[str]
+    last_modified: Optional[str]
+
+    @property
+    def content_hash(self) -> str:
+        return hashlib.sha256(self.content).hexdigest()
+
+
+async def fetch_calendar_page(url: Optional[str] = None, previous: Optional[db.PageState] = None,
+                              calendar: Optional[Calendar] = None) -> CalendarPage:
     """
-    Fetches the schedule by first getting a session cookie from the main site,
-    then accessing the calendar page.
+    Fetches a page of a calendar (the default one if not given) over its session. The
+    session cookie is only fetched again when it has expired or when the calendar rejects
+    the request. If we fetched this page before, the request is made conditional on it having changed.
     """
-    # Use a Session object to persist cookies across requests
-    with requests.Session() as session:
-        # It's good practice to always set a User-Agent
-        session.headers.update({
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
-        })
-
-        try:
-            # Step 1: Visit the initial page to acquire the session cookie
-            logger.info(f"Acquiring session cookie from: {COOKIE_URL}")
-            cookie_response = session.get(COOKIE_URL, timeout=15)
-            cookie_response.raise_for_status()
-            logger.info("Successfully acquired session cookie.")
+    calendar = calendar or get_calendar()
+    url = url or calendar.calendar_url
+    session = _get_session(calendar)
+    client = session.get_client()
+
+    headers = {}
+    if previous is not None:
+        if previous.etag:
+            headers["If-None-Match"] = previous.etag
+        if previous.last_modified:
+            headers["If-Modified-Since"] = previous.last_modified
+
+    async with session.lock:
+        if not session.cookie_is_valid():
+            await session.acquire_cookie()
+        cookie_used = session.cookie_acquired_at
+
+    logger.info(f"Fetching calendar from: {url}")
+    response = await client.get(url, headers=headers)
+    if session.is_rejected(response):
+        logger.info("Calendar rejected the session cookie. Refreshing it and retrying once.")
+        metrics.inc("cookie_rejections_total", calendar=calendar.id)
+        async with session.lock:
+            # Another page of the same run may have refreshed the cookie already.
+            if session.cookie_acquired_at == cookie_used:
+                await session.acquire_cookie()
+        response = await client.get(url, headers=headers)
+
+    if response.status_code == 304 and previous is not None:
+        logger.info(f"Calendar page not modified since the last check: {url}")
+        metrics.inc("calendar_pages_total", calendar=calendar.id, result="not_modified")
+        return CalendarPage(url, b"", True, previous.etag, previous.last_modified)
+
+    response.raise_for_status()
+    logger.info(f"Successfully fetched schedule HTML ({len(response.content)} bytes).")
+    metrics.inc("http_bytes_fetched_total", len(response.content))
+    return CalendarPage(url, response.content, False,
+                        response.headers.get("ETag"), response.headers.get("Last-Modified"))
+
+
+# --- Multi-Week Horizon ---
+
+def d_value_for(target: date, calendar: Optional[Calendar] = None) -> int:
+    """Converts a date to the calendar's 'd' parameter (one step per day)."""
+    calendar = calendar or get_calendar()
+    reference = date.fromisoformat(calendar.reference_date)
+    return calendar.reference_d_value + (target - reference).days
+
+
+def get_week_urls(weeks: Optional[int] = None, today: Optional[date] = None,
+                  calendar: Optional[Calendar] = None) -> List[str]:
+    """Returns the calendar URL for the current week and each of the following weeks."""
+    calendar = calendar or get_calendar()
+    weeks = calendar.weeks_ahead if weeks is None else weeks
+    today = today or date.today()
+    first_d = d_value_for(today, calendar)
+    return [f"{calendar.calendar_url}&d={first_d + 7 * week}" for week in range(weeks)]
+
 
-            # Step 2: Access the calendar page. The session will automatically send the cookie.
-            logger.info(f"Fetching calendar from: {BASE_CALENDAR_URL}")
-            schedule_response = session.get(BASE_CALENDAR_URL, timeout=15)
-            schedule_response.raise_for_status()
-            logger.info(f"Successfully fetched schedule HTML ({len(schedule_response.content)} bytes).")
+def _get_parse_executor() -> Optional[Executor]:
+    """Returns the process pool used to parse pages in parallel, or None to parse in a thread."""
+    global _parse_executor
+    if _parse_executor is None and PARSE_WORKERS > 0:
+        # Spawned, not forked: by now this process runs the database and metrics threads, and a
+        # child forked while one of them holds a lock (e.g. the logging lock) can hang on it.
+        # Spawning re-imports __main__ (bot.py or worker.py) in every child, so each worker still
+        # runs that module's imports, database initialization included, once when it starts.
+        _parse_executor = ProcessPoolExecutor(max_workers=PARSE_WORKERS,
+                                              mp_context=multiprocessing.get_context("spawn"))
+    return _parse_executor
 
-            return parse_fencing_schedule(schedule_response.content)
 
-        except requests.RequestException as e:
-            logger.error(f"FATAL: A network error occurred during the scraping process. Exception: {e}")
-            return []
+async def _parse_page(html: bytes, calendar: Calendar) -> List[Slot]:
+    """Parses a calendar page off the event loop, in the parse pool if there is one, otherwise in a thread."""
+    executor = _get_parse_executor()
+    loop = asyncio.get_running_loop()
+    if executor is None:
+        return await loop.run_in_executor(None, parse_fencing_schedule, html, calendar.parser_engine, calendar.id)
+    # Only the parse runs in the worker; tagging the slots with their calendar stays here.
+    schedule = await loop.run_in_executor(executor, parsers.parse, html, calendar.parser_engine)
+    return [slot.in_calendar(calendar.id) for slot in schedule]
 
 
-def parse_fencing_schedule(html: bytes) -> List[Dict[str, str]]:
+def merge_schedules(pages: List[List[Slot]]) -> List[Slot]:
+    """Merges per-week schedules in order, dropping slots that appear on two overlapping pages."""
+    merged = []
+    seen = set()
+    for page in pages:
+        for slot in page:
+            if slot.key not in seen:
+                seen.add(slot.key)
+                merged.append(slot)
+    return merged
+
+
+class ScrapeError(Exception):
+    """Raised when no calendar page could be fetched at all."""
+
+
+class ScheduleFetch(NamedTuple):
+    """The merged schedule and whether any page differed from the previous fetch."""
+    schedule: List[Slot]
+    changed: bool
+
+
+async def fetch_schedule(weeks: Optional[int] = None, calendar: Optional[Calendar] = None) -> ScheduleFetch:
     """
-    Parses the HTML using a robust "bottom-up" approach.
+    Fetches a calendar's pages (the default calendar's if not given) for the next `weeks`
+    weeks concurrently, parses them in parallel and merges them into one schedule.
+
+    Pages the server reports as not modified, or whose content hash matches the last
+    fetch, are not parsed again; their previous slots are reused.
+    Raises ScrapeError if none of the pages could be fetched.
+
+    With SCRAPE_SOURCE = "archive" the pages come from the page archive instead of the site.
     """
-    if not html:
-        return []
+    calendar = calendar or get_calendar()
+    if SCRAPE_SOURCE == "archive":
+        return await _replay_schedule(weeks, calendar)
+    urls = get_week_urls(weeks, calendar=calendar)
+    page_states = await db.run_async(db.get_page_states, urls)
+
+    async def fetch_and_parse(url: str) -> Tuple[List[Slot], bool]:
+        previous = page_states.get(url)
+        async with _fetch_semaphore:
+            with metrics.span("calendar_fetch", calendar=calendar.id):
+                page = await fetch_calendar_page(url, previous, calendar)
+        if not page.not_modified:
+            await _archive_page(page)
+        if previous is not None and (page.not_modified or page.content_hash == previous.content_hash):
+            if not page.not_modified:
+                metrics.inc("calendar_pages_total", calendar=calendar.id, result="unchanged")
+            return previous.slots, False
+        metrics.inc("calendar_pages_total", calendar=calendar.id, result="changed")
+        with metrics.span("parse"):
+            slots = await _parse_page(page.content, calendar)
+        metrics.inc("slots_parsed_total", len(slots))
+        await db.run_async(db.save_page_state, url, page.content_hash, page.etag, page.last_modified, slots)
+        return slots, True
+
+    results = await asyncio.gather(*(fetch_and_parse(url) for url in urls), return_exceptions=True)
+
+    pages = []
+    changed = False
+    for url, result in zip(urls, results):
+        if isinstance(result, httpx.HTTPError):
+            logger.error(f"FATAL: A network error occurred while fetching {url}. Exception: {result}")
+        elif isinstance(result, BaseException):
+            raise result
+        else:
+            slots, page_changed = result
+            pages.append(slots)
+            changed = changed or page_changed
+
+    if not pages:
+        raise ScrapeError(f"None of the {len(urls)} calendar weeks could be fetched.")
+    if len(pages) < len(urls):
+        logger.warning(f"Only {len(pages)} of {len(urls)} calendar weeks could be fetched.")
+    if not changed:
+        logger.info("All calendar pages are unchanged since the last check.")
+
+    return ScheduleFetch(merge_schedules(pages), changed)
+
+
+# --- Page Archive ---
 
-    soup = BeautifulSoup(html, 'html.parser')
-    schedule = []
-    coach_headers = soup.find_all('tr', {'height': '24', 'bgcolor': '#ffff66'})
+async def _archive_page(page: CalendarPage):
+    """Keeps a copy of a fetched page. Archiving problems are logged, never raised."""
+    if not PAGE_ARCHIVE_DIR:
+        return
+    try:
+        written = await asyncio.to_thread(page_archive.store, page.url, page.content, page.content_hash)
+    except OSError as e:
+        logger.warning(f"Could not archive the calendar page {page.url}: {e}")
+        return
+    metrics.inc("pages_archived_total", result="new" if written else "duplicate")
 
-    if not coach_headers:
-        logger.warning("Parser did not find any coach header rows. The page might be empty or changed.")
+
+# Content hashes of the pages the last replay returned, to report `changed` like a live fetch.
+_replayed_hashes: Dict[str, str] = {}
+
+
+async def _replay_schedule(weeks: Optional[int], calendar: Calendar) -> ScheduleFetch:
+    """
+    Builds the schedule from archived pages, as the site served them at SCRAPE_REPLAY_AT
+    (or at the newest archived fetch). Nothing is fetched and no page state is saved.
+    """
+    if SCRAPE_REPLAY_AT:
+        replay_at = datetime.fromisoformat(SCRAPE_REPLAY_AT).timestamp()
+    else:
+        replay_at = await asyncio.to_thread(page_archive.latest_fetch_time)
+    if replay_at is None:
+        raise ScrapeError(f"The page archive in '{PAGE_ARCHIVE_DIR}' is empty.")
+
+    urls = get_week_urls(weeks, datetime.fromtimestamp(replay_at).date(), calendar)
+    archived = await asyncio.to_thread(page_archive.pages_at, urls, replay_at)
+    if not archived:
+        raise ScrapeError(f"None of the {len(urls)} calendar weeks are in the page archive.")
+    if len(archived) < len(urls):
+        logger.warning(f"Only {len(archived)} of {len(urls)} calendar weeks are in the page archive.")
+
+    with metrics.span("parse"):
+        pages = await asyncio.gather(*(_parse_page(html, calendar) for html in archived.values()))
+    hashes = {url: hashlib.sha256(html).hexdigest() for url, html in archived.items()}
+    changed = any(_replayed_hashes.get(url) != content_hash for url, content_hash in hashes.items())
+    _replayed_hashes.update(hashes)
+    return ScheduleFetch(merge_schedules(pages), changed)
+
+
+async def get_full_schedule(weeks: Optional[int] = None, calendar: Optional[Calendar] = None) -> List[Slot]:
+    """Same as fetch_schedule, but returns an empty list if the site cannot be reached."""
+    try:
+        return (await fetch_schedule(weeks, calendar)).schedule
+    except ScrapeError as e:
+        logger.error(f"FATAL: {e}")
         return []
 
-    for header in coach_headers:
-        coach_name_tag = header.find('a', class_='maintext')
-        if not coach_name_tag or "Coach:" not in coach_name_tag.text:
-            continue
-        current_coach = coach_name_tag.text.replace("Coach:", "").strip()
-
-        day_column = header.find_parent('td', class_='tdborder')
-        if not day_column:
-            continue
-
-        day_header = day_column.find('tr', {'height': '34'})
-        if not day_header:
-            continue
-
-        day_of_week = day_header.find('a', class_='mainbold').text.strip() if day_header.find('a',
-                                                                                              class_='mainbold') else "Unknown"
-        full_date = day_header.find('a', class_='smallbold').text.strip() if day_header.find('a',
-                                                                                             class_='smallbold') else "Unknown"
-
-        for slot_row in header.find_next_siblings('tr'):
-            columns = slot_row.find_all('td', class_='tdborder', recursive=False)
-            if len(columns) == 2:
-                time = columns[0].text.strip()
-                status = 'Available' if columns[1].find('input') else 'Booked'
-                schedule.append({
-                    'day': day_of_week, 'date': full_date, 'coach': current_coach,
-                    'time': time, 'status': status
-                })
 
+def parse_fencing_schedule(html: bytes, engine: str = PARSER_ENGINE,
+                           calendar_id: str = DEFAULT_CALENDAR_ID) -> List[Slot]:
+    """
+    Parses a calendar page into slot rows using the configured parser engine.
+    See parsers.py for the available engines.
+    """
+    schedule = parsers.parse(html, engine)
+    if calendar_id != DEFAULT_CALENDAR_ID:
+        schedule = [slot.in_calendar(calendar_id) for slot in schedule]
     return schedule
 
 
-def get_available_classes() -> List[Dict[str, str]]:
+async def get_available_classes() -> List[Slot]:
     """Fetches the live schedule and returns a list of only available classes."""
-    full_schedule = get_full_schedule()
-    return [slot for slot in full_schedule if slot['status'] == 'Available']
+    full_schedule = await get_full_schedule()
+    return [slot for slot in full_schedule if slot.available]
+
+
+def get_all_coaches(calendar_id: Optional[str] = None) -> List[str]:
+    """
+    Returns a sorted list of the coach names recently seen on a calendar, from the coach
+    directory. Until a schedule has been fetched, the calendar's configured coaches are
+    used instead. Never touches the network.
+    """
+    calendar = get_calendar(calendar_id)
+    return coach_directory.names(calendar.id) or list(calendar.coaches)
 
 
-def get_all_coaches() -> List[str]:
-    """Fetches the schedule and returns a unique, sorted list of all coach names."""
-    # full_schedule = get_full_schedule()
-    # if not full_schedule:
-    #     logger.warning("get_full_schedule() returned no data, so coach list is empty.")
-    #     return []
-    #
-    # coaches = {slot['coach'] for slot in full_schedule if slot['coach'] and slot['coach'] != "Unknown Coach"}
-    # return sorted(list(coaches))
-    return ['Arseni', 'David G', 'Igor']
+async def _self_test():
+    try:
+        return await get_available_classes()
+    finally:
+        await close_session()
 
 
 if __name__ == '__main__':
@@ -116,7 +392,7 @@ if __name__ == '__main__':
     coaches = get_all_coaches()
     if coaches:
         print(f"✅ SUCCESS: Found {len(coaches)} coaches: {coaches}")
-        available = get_available_classes()
+        available = asyncio.run(_self_test())
         print(f"✅ Found {len(available)} available slots. Sample: {available[:3]}")
     else:
         print("❌ FAILURE: Could not fetch coach list. Check logs for warnings/errors.")
\ No newline at end of file
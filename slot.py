@@ -0,0 +1,148 @@
+# slot.py
+
+import functools
+import sys
+from datetime import date, datetime
+from typing import Dict, Iterator, Optional, Tuple, Union
+
+from config import DEFAULT_CALENDAR_ID
+from matcher import parse_minutes
+
+# Date formats seen in the calendar's day header, most likely first.
+SLOT_DATE_FORMATS = ["%m/%d/%Y", "%m/%d/%y", "%B %d, %Y", "%b %d, %Y", "%Y-%m-%d"]
+
+
+def parse_slot_date(text: str, today: Optional[date] = None) -> Optional[date]:
+    """
+    Converts the date shown in a day header to a date, or None if it is not recognised.
+    Dates without a year ('9/24') are taken to be the next occurrence from today.
+    """
+    text = text.strip()
+    for fmt in SLOT_DATE_FORMATS:
+        try:
+            return datetime.strptime(text, fmt).date()
+        except ValueError:
+            continue
+    try:
+        month_day = datetime.strptime(text, "%m/%d")
+    except ValueError:
+        return None
+    today = today or date.today()
+    try:
+        candidate = date(today.year, month_day.month, month_day.day)
+    except ValueError:  # Feb 29 in a non-leap year
+        return None
+    # A date more than a month in the past belongs to next year's calendar.
+    if (today - candidate).days > 31:
+        candidate = candidate.replace(year=today.year + 1)
+    return candidate
+
+
+# A page has seven dates and a few dozen distinct times, so each is parsed once and reused.
+@functools.lru_cache(maxsize=1024)
+def _cached_date(text: str, today: date) -> Optional[date]:
+    return parse_slot_date(text, today)
+
+
+@functools.lru_cache(maxsize=4096)
+def _cached_minutes(time_text: str) -> Tuple[Optional[int], Optional[int]]:
+    start, _, end = time_text.partition('-')
+    return parse_minutes(start.strip()), parse_minutes(end.strip())
+
+
+class Slot:
+    """
+    One row of a calendar.
+
+    Coach, day, date and time strings are interned, since every page repeats the same
+    few values thousands of times. The date and the start/end minutes are parsed once
+    here, and the dedup key and hash are computed once. Existing callers can still
+    read the row like the old dict: slot['coach'], slot['status'] and so on.
+
+    Slots of calendars other than the default one have their calendar id in front of
+    their key, so the same coach and time at two clubs are two different slots.
+    """
+
+    __slots__ = ('day', 'date', 'coach', 'time', 'available', 'calendar', 'slot_date', 'start_minute',
+                 'end_minute', 'key')
+
+    FIELDS = ('day', 'date', 'coach', 'time', 'status')
+
+    def __init__(self, day: str, date_text: str, coach: str, time: str, available: bool,
+                 calendar: str = DEFAULT_CALENDAR_ID):
+        self.day = sys.intern(day)
+        self.date = sys.intern(date_text)
+        self.coach = sys.intern(coach)
+        self.time = sys.intern(time)
+        self.available = available
+        self.calendar = sys.intern(calendar)
+        self.slot_date = _cached_date(date_text, date.today())
+        self.start_minute, self.end_minute = _cached_minutes(time)
+        # Also the notification dedup key, so it must stay in this format.
+        self.key = (f"{coach}-{date_text}-{time}" if calendar == DEFAULT_CALENDAR_ID
+                    else f"{calendar}:{coach}-{date_text}-{time}")
+
+    @property
+    def status(self) -> str:
+        return 'Available' if self.available else 'Booked'
+
+    # --- Dict-compatible view ---
+
+    def __getitem__(self, field: str) -> str:
+        if field not in self.FIELDS:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    def get(self, field: str, default=None):
+        return getattr(self, field) if field in self.FIELDS else default
+
+    def keys(self) -> Tuple[str, ...]:
+        return self.FIELDS
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.FIELDS)
+
+    def to_dict(self) -> Dict[str, str]:
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    @classmethod
+    def from_dict(cls, row: Dict[str, str], calendar: str = DEFAULT_CALENDAR_ID) -> "Slot":
+        return cls(row['day'], row['date'], row['coach'], row['time'], row['status'] == 'Available', calendar)
+
+    def in_calendar(self, calendar: str) -> "Slot":
+        """This slot as a row of the given calendar (parsers build rows of the default one)."""
+        if calendar == self.calendar:
+            return self
+        return Slot(self.day, self.date, self.coach, self.time, self.available, calendar)
+
+    # --- Compact storage (page_state JSON) ---
+
+    def to_row(self) -> Tuple[str, str, str, str, bool, str]:
+        return self.day, self.date, self.coach, self.time, self.available, self.calendar
+
+    @classmethod
+    def from_row(cls, row: Union[list, tuple, Dict[str, str]]) -> "Slot":
+        """Builds a slot from to_row() output, or from the rows and dicts older versions stored."""
+        if isinstance(row, dict):
+            return cls.from_dict(row)
+        return cls(*row)
+
+    # --- Identity ---
+
+    def __hash__(self) -> int:
+        return hash(self.key)  # str caches its own hash
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, Slot):
+            return self.key == other.key and self.day == other.day and self.available == other.available
+        if isinstance(other, dict):
+            return self.to_dict() == other
+        return NotImplemented
+
+    def __reduce__(self):
+        # Rebuilt through __init__ so strings are interned again in the receiving process.
+        return Slot, self.to_row()
+
+    def __repr__(self) -> str:
+        calendar = "" if self.calendar == DEFAULT_CALENDAR_ID else f", {self.calendar!r}"
+        return f"Slot({self.day!r}, {self.date!r}, {self.coach!r}, {self.time!r}, {self.status}{calendar})"
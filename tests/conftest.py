@@ -0,0 +1,10 @@
+# tests/conftest.py
+
+import os
+import sys
+import tempfile
+
+# The modules under test open the database when imported, so point them at a scratch one
+# before any test module imports them.
+os.environ["DB_NAME"] = os.path.join(tempfile.mkdtemp(prefix="fencing_alerts_tests_"), "test.db")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,49 @@
+# tests/test_database.py
+
+import sqlite3
+
+import pytest
+
+import database as db
+
+
+@pytest.fixture
+def old_database(tmp_path, monkeypatch):
+    """A database file with the alerts table as it was before the normalized columns."""
+    path = str(tmp_path / "old.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE alerts (id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER NOT NULL, "
+                 "coach_name TEXT NOT NULL, days_of_week TEXT NOT NULL, time_range TEXT NOT NULL)")
+    conn.execute("INSERT INTO alerts (chat_id, coach_name, days_of_week, time_range) "
+                 "VALUES (1, 'Coach A', 'Monday', '10:00-12:00')")
+    conn.commit()
+    conn.close()
+    db.close_database()
+    monkeypatch.setattr(db, "DB_NAME", path)
+    yield path
+    db.close_database()
+
+
+def alert_columns(path):
+    conn = sqlite3.connect(path)
+    try:
+        return [column[1] for column in conn.execute("PRAGMA table_info(alerts)")]
+    finally:
+        conn.close()
+
+
+def test_failed_migration_leaves_the_old_schema(old_database, monkeypatch):
+    def fail(*args):
+        raise RuntimeError("migration failed")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(db, "_alert_columns", fail)
+        with pytest.raises(RuntimeError):
+            db.initialize_database()
+    db.close_database()
+    assert alert_columns(old_database) == ["id", "chat_id", "coach_name", "days_of_week", "time_range"]
+
+    # The next start runs the whole migration again.
+    db.initialize_database()
+    assert "day_mask" in alert_columns(old_database)
+    assert db.get_alerts_after(0)[0][2:] == ("Coach A", "Monday", "10:00-12:00", db.DEFAULT_CALENDAR_ID)
@@ -0,0 +1,25 @@
+# tests/test_parsers.py
+
+import json
+import os
+
+import pytest
+
+from parsers import GOLDEN_DIR, PARSER_ENGINES
+
+GOLDEN_PAGES = sorted(name for name in os.listdir(GOLDEN_DIR) if name.endswith(".html"))
+
+
+@pytest.mark.parametrize("engine", sorted(PARSER_ENGINES))
+@pytest.mark.parametrize("page", GOLDEN_PAGES)
+def test_engine_matches_golden_page(engine, page):
+    path = os.path.join(GOLDEN_DIR, page)
+    with open(path, 'rb') as f:
+        html = f.read()
+    with open(path[:-len(".html")] + ".json") as f:
+        expected = json.load(f)
+    assert [slot.to_dict() for slot in PARSER_ENGINES[engine](html)] == expected
+
+
+def test_golden_pages_exist():
+    assert GOLDEN_PAGES
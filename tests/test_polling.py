@@ -0,0 +1,32 @@
+# tests/test_polling.py
+
+import asyncio
+import time
+
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+
+from polling import AdaptivePoller
+from scheduler import CheckResult
+
+
+def test_late_run_still_fires_and_reschedules():
+    async def scenario():
+        scheduler = AsyncIOScheduler(timezone="UTC")
+        runs = []
+
+        async def check():
+            runs.append(time.monotonic())
+            return CheckResult(changed=True)
+
+        poller = AdaptivePoller(scheduler, check, min_interval=0.2, max_interval=0.2, jitter=0)
+        scheduler.start()
+        poller.start(delay=0.1)
+        time.sleep(2.5)  # Block the event loop well past the run's due time
+        await asyncio.sleep(1)
+        poller.stop()
+        scheduler.shutdown(wait=False)
+        return runs
+
+    runs = asyncio.run(scenario())
+    # The overdue run happened, and it scheduled the ones after it.
+    assert len(runs) >= 3
@@ -0,0 +1,27 @@
+# tests/test_worker.py
+
+import asyncio
+
+import database as db
+import worker
+
+
+def test_alerts_created_while_down_are_evaluated(monkeypatch):
+    evaluated = []
+
+    async def evaluate_alerts(bot, alerts, triggered_by):
+        evaluated.extend(alert[0] for alert in alerts)
+
+    monkeypatch.setattr(worker, "evaluate_alerts", evaluate_alerts)
+    existing = db.add_alert(1, "Coach A", "Monday", "10:00-12:00")
+    asyncio.run(worker.NewAlertWatcher().check())
+    # The first check starts at the newest alert; it was already evaluated when it was created.
+    assert existing not in evaluated
+
+    # Created while no worker is running; a fresh watcher (e.g. after a restart) picks it up.
+    missed = db.add_alert(1, "Coach B", "Tuesday", "10:00-12:00")
+    asyncio.run(worker.NewAlertWatcher().check())
+    assert evaluated == [missed]
+
+    asyncio.run(worker.NewAlertWatcher().check())
+    assert evaluated == [missed]
@@ -0,0 +1,89 @@
+# worker.py
+#
+# The scraping half of a split deployment (RUN_MODE=worker). It polls the calendars,
+# matches slots against alerts and queues the resulting messages in the database
+# outbox; the bot process (RUN_MODE=bot) delivers them. Run with `python worker.py`.
+# With CLUSTER_SHARDS set, several workers can run side by side (see cluster.py).
+
+import asyncio
+import logging
+import signal
+
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+
+import database as db
+import scraper
+from cluster import Cluster
+from config import CLUSTER_SHARDS, COMPACTION_HOUR_UTC, METRICS_HOST, METRICS_PORT, OUTBOX_POLL_SECONDS
+from metrics import start_metrics_server, stop_metrics_server
+from polling import calendar_pollers
+from scheduler import check_and_notify_all_users, compact_notification_history, evaluate_alerts
+
+# Get the logger
+logger = logging.getLogger(__name__)
+
+
+class NewAlertWatcher:
+    """
+    Alerts are created in the bot process, so the worker notices them by watching for
+    ids above the last one it evaluated. Only those alerts are evaluated, like the
+    single-process bot does right after an alert is created. The watermark lives in the
+    database, so alerts created while no worker (or no leader) was running are still
+    evaluated when one takes over.
+    """
+
+    async def check(self):
+        last_alert_id = await db.run_async(db.get_alert_watermark)
+        new_alerts = await db.run_async(db.get_alerts_after, last_alert_id)
+        if new_alerts:
+            await evaluate_alerts(None, new_alerts, f"new alerts up to id {new_alerts[-1][0]}")
+            await db.run_async(db.advance_alert_watermark, new_alerts[-1][0])
+
+
+async def run():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    scheduler = AsyncIOScheduler(timezone="UTC")
+    watcher = NewAlertWatcher()
+    cluster = None
+    if CLUSTER_SHARDS:
+        # Only the leader scrapes, watches for new alerts and compacts; the shards are shared out.
+        cluster = Cluster(None, scheduler)
+        cluster.start()
+        check_new_alerts = cluster.leader_only(watcher.check)
+        compact = cluster.leader_only(compact_notification_history)
+    else:
+        for poller in calendar_pollers(scheduler, lambda calendar: check_and_notify_all_users(
+                None, "scheduled poll", max_age=0, calendar_id=calendar.id)):
+            poller.start()
+        await watcher.check()
+        check_new_alerts, compact = watcher.check, compact_notification_history
+    scheduler.add_job(check_new_alerts, 'interval', seconds=OUTBOX_POLL_SECONDS, max_instances=1, coalesce=True)
+    scheduler.add_job(compact, 'cron', hour=COMPACTION_HOUR_UTC)
+    scheduler.start()
+    start_metrics_server(METRICS_HOST, METRICS_PORT + 1 if METRICS_PORT else 0)
+    logger.info("Worker started.")
+
+    try:
+        await stop.wait()
+    finally:
+        logger.info("Worker stopping.")
+        scheduler.shutdown(wait=False)
+        if cluster is not None:
+            await cluster.stop()
+        await scraper.close_session()
+        db.close_database()
+        stop_metrics_server()
+
+
+def main() -> None:
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    logging.getLogger("apscheduler.executors.default").setLevel(logging.WARNING)
+    main()